@@ -1,172 +1,271 @@
-import os
-import pandas as pd
-import psycopg2
-from psycopg2 import extensions
-from sqlalchemy import create_engine, MetaData, Table, Column, Integer, String, Float
-from sqlalchemy.dialects.postgresql import DOUBLE_PRECISION
-
-POSTGRES_HOST = os.getenv('POSTGRES_HOST')
-POSTGRES_PORT = os.getenv('POSTGRES_PORT')
-POSTGRES_DB = os.getenv('POSTGRES_DB')
-POSTGRES_USER = os.getenv('POSTGRES_USER')
-POSTGRES_PASSWORD = os.getenv('POSTGRES_PASSWORD')
-DATA_DIR = '/create-db/dbfiles/'
-
-def create_database_and_tables():
-    # Étape 1 : Création de la base de données
-    conn = None
-    try:
-        # Connexion sans spécifier de base de données
-        conn = psycopg2.connect(
-            host=POSTGRES_HOST,
-            port=POSTGRES_PORT,
-            user=POSTGRES_USER,
-            password=POSTGRES_PASSWORD
-        )
-        conn.set_isolation_level(extensions.ISOLATION_LEVEL_AUTOCOMMIT)
-        cur = conn.cursor()
-
-        # Suppression et création de la base de données
-        cur.execute(f'DROP DATABASE IF EXISTS {POSTGRES_DB};')
-        cur.execute(f'CREATE DATABASE {POSTGRES_DB};')
-        print(f"La base de données '{POSTGRES_DB}' a été créée avec succès.")
-        cur.close()
-    except Exception as e:
-        print("Erreur lors de la création de la base de données :", e)
-    finally:
-        if conn:
-            conn.close()
-
-    # Étape 2 : Création des tables
-    try:
-        # Connexion à la nouvelle base de données
-        engine = create_engine(f"postgresql+psycopg2://{POSTGRES_USER}:{POSTGRES_PASSWORD}@{POSTGRES_HOST}:{POSTGRES_PORT}/{POSTGRES_DB}")
-        metadata = MetaData()
-
-        # Définir les tables
-        logements = Table('Logements', metadata,
-                          Column('url', String, primary_key=True),
-                          Column('price', Float),
-                          Column('address', String),
-                          Column('bedrooms', Integer),
-                          Column('bathrooms', Integer),
-                          Column('powder_rooms', Integer),
-                          Column('stories', Integer),
-                          Column('construction_year', Integer),
-                          Column('property_style', String),
-                          Column('floors', Integer),
-                          Column('municipal_valuation', Float),
-                          Column('parking_spaces', Integer),
-                          Column('living_area', Float), 
-                          Column('land_area', Float),
-                          Column('latitude', DOUBLE_PRECISION),
-                          Column('longitude', DOUBLE_PRECISION),
-                          Column('postal_code', String),
-                          Column('fsa', String))
-
-        lignes_metro = Table('ligne_metro', metadata,
-                             Column('route_id', String),
-                             Column('route_name', String),
-                             Column('headsign', String),
-                             Column('shape_id', String),
-                             Column('service_id', String),
-                             Column('Latitude', DOUBLE_PRECISION),
-                             Column('Longitude', DOUBLE_PRECISION),
-                             Column('Postal Code', String),
-                             Column('FSA', String))
-
-        arrets_metro = Table('arrets_metro', metadata,
-                             Column('stop_id', String),
-                             Column('stop_code', Integer),
-                             Column('stop_name', String),
-                             Column('stop_url', String),
-                             Column('wheelchair', Integer),
-                             Column('route_id', String),
-                             Column('loc_type', Integer),
-                             Column('service_id', String),
-                             Column('Latitude', DOUBLE_PRECISION),
-                             Column('Longitude', DOUBLE_PRECISION),
-                             Column('Postal Code', String),
-                             Column('FSA', String))
-
-        borne_recharge = Table('bornes-recharge-publiques-a-jour', metadata,
-                               Column('NOM_BORNE_RECHARGE', String, primary_key=True),
-                               Column('NOM_PARC', String),
-                               Column('ADRESSE', String),
-                               Column('VILLE', String),
-                               Column('NIVEAU_RECHARGE', String),
-                               Column('MODE_TARIFICATION', String),
-                               Column('TYPE_EMPLACEMENT', String),
-                               Column('Longitude', DOUBLE_PRECISION),
-                               Column('Latitude', DOUBLE_PRECISION),
-                               Column('Postal Code', String),
-                               Column('FSA', String))
-
-        stationnement_deneigement = Table('stationnements-h-2023-2024', metadata,
-                                          Column('ID_STA', Integer, primary_key=True),
-                                          Column('ARRONDISSEMENT', String),
-                                          Column('NBR_PLA', Integer),
-                                          Column('JURIDICTION', String),
-                                          Column('EMPLACEMENT', String),
-                                          Column('HEURES', String),
-                                          Column('HOURS', String),
-                                          Column('NOTE_FR', String),
-                                          Column('Latitude', DOUBLE_PRECISION),
-                                          Column('Longitude', DOUBLE_PRECISION),
-                                          Column('Postal Code', String),
-                                          Column('FSA', String))
-
-        # Créer les tables dans la base
-        metadata.create_all(engine)
-        print(f"Les tables ont été créées avec succès dans la base '{POSTGRES_DB}'.")
-
-        return engine, metadata
-    except Exception as e:
-        print("Erreur lors de la création des tables :", e)
-        return None, None
-    finally:
-        if engine:
-            engine.dispose()
-        print("Connexion à la base de données fermée.")
-
-# Fonction pour charger les données dans les tables
-def load_data(engine, metadata, data_dir):
-    try:
-        for filename in os.listdir(data_dir):
-            file_wo_ext = os.path.splitext(filename)[0]
-            file_path = os.path.join(data_dir, filename)
-
-            # Charger les données du fichier CSV ou XLSX
-            if filename.endswith(".csv") and os.path.isfile(file_path):
-                df = pd.read_csv(file_path)
-            elif filename.endswith(".xlsx") and os.path.isfile(file_path):
-                df = pd.read_excel(file_path)
-            else:
-                continue  # Skip files that ne sont pas au format attendu
-
-            # Suppression des colonnes sans nom
-            df = df.loc[:, ~df.columns.str.contains('^Unnamed')]
-
-            # Vérifier si la table correspondante existe
-            if file_wo_ext in metadata.tables:
-                df.to_sql(file_wo_ext, engine, if_exists='append', index=False)
-                print(f"Les données ont été importées dans la table '{file_wo_ext}'.")
-            else:
-                print(f"Aucune table correspondante trouvée pour '{file_wo_ext}'.")
-
-    except Exception as e:
-        print("Erreur lors de l'importation des données :", e)
-    
-    finally:
-        # Ensure the connection is closed
-        if engine:
-            engine.dispose()
-        print("Connexion à la base de données fermée.")
-
-
-# Appel des fonctions principales
-if __name__ == "__main__":
-    engine, metadata = create_database_and_tables()
-    if engine and metadata:
-        load_data(engine, metadata, DATA_DIR)
-        engine.dispose()
+import os
+import io
+import time
+import glob
+import hashlib
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import pandas as pd
+import psycopg2
+from psycopg2 import extensions
+from sqlalchemy import create_engine, MetaData, Table, Column, Integer, String, Float
+from sqlalchemy.dialects.postgresql import DOUBLE_PRECISION
+
+POSTGRES_HOST = os.getenv('POSTGRES_HOST')
+POSTGRES_PORT = os.getenv('POSTGRES_PORT')
+POSTGRES_DB = os.getenv('POSTGRES_DB')
+POSTGRES_USER = os.getenv('POSTGRES_USER')
+POSTGRES_PASSWORD = os.getenv('POSTGRES_PASSWORD')
+DB_URL = f"postgresql+psycopg2://{POSTGRES_USER}:{POSTGRES_PASSWORD}@{POSTGRES_HOST}:{POSTGRES_PORT}/{POSTGRES_DB}"
+DATA_DIR = '/create-db/dbfiles/'
+LOAD_MODE = os.getenv('LOAD_MODE', 'copy')
+COPY_CHUNK_SIZE = int(os.getenv('COPY_CHUNK_SIZE', 50000))
+CACHE_DIR = os.getenv('CACHE_DIR', '/create-db/cache/')
+LOAD_WORKERS = int(os.getenv('LOAD_WORKERS', os.cpu_count() or 1))
+
+def create_database_and_tables():
+    # Étape 1 : Création de la base de données
+    conn = None
+    try:
+        # Connexion sans spécifier de base de données
+        conn = psycopg2.connect(
+            host=POSTGRES_HOST,
+            port=POSTGRES_PORT,
+            user=POSTGRES_USER,
+            password=POSTGRES_PASSWORD
+        )
+        conn.set_isolation_level(extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+        cur = conn.cursor()
+
+        # Suppression et création de la base de données
+        cur.execute(f'DROP DATABASE IF EXISTS {POSTGRES_DB};')
+        cur.execute(f'CREATE DATABASE {POSTGRES_DB};')
+        print(f"La base de données '{POSTGRES_DB}' a été créée avec succès.")
+        cur.close()
+    except Exception as e:
+        print("Erreur lors de la création de la base de données :", e)
+    finally:
+        if conn:
+            conn.close()
+
+    # Étape 2 : Création des tables
+    try:
+        # Connexion à la nouvelle base de données
+        engine = create_engine(DB_URL)
+        metadata = MetaData()
+
+        # Définir les tables
+        logements = Table('Logements', metadata,
+                          Column('url', String, primary_key=True),
+                          Column('price', Float),
+                          Column('address', String),
+                          Column('bedrooms', Integer),
+                          Column('bathrooms', Integer),
+                          Column('powder_rooms', Integer),
+                          Column('stories', Integer),
+                          Column('construction_year', Integer),
+                          Column('property_style', String),
+                          Column('floors', Integer),
+                          Column('municipal_valuation', Float),
+                          Column('parking_spaces', Integer),
+                          Column('living_area', Float), 
+                          Column('land_area', Float),
+                          Column('latitude', DOUBLE_PRECISION),
+                          Column('longitude', DOUBLE_PRECISION),
+                          Column('postal_code', String),
+                          Column('fsa', String))
+
+        lignes_metro = Table('ligne_metro', metadata,
+                             Column('route_id', String),
+                             Column('route_name', String),
+                             Column('headsign', String),
+                             Column('shape_id', String),
+                             Column('service_id', String),
+                             Column('Latitude', DOUBLE_PRECISION),
+                             Column('Longitude', DOUBLE_PRECISION),
+                             Column('Postal Code', String),
+                             Column('FSA', String))
+
+        arrets_metro = Table('arrets_metro', metadata,
+                             Column('stop_id', String),
+                             Column('stop_code', Integer),
+                             Column('stop_name', String),
+                             Column('stop_url', String),
+                             Column('wheelchair', Integer),
+                             Column('route_id', String),
+                             Column('loc_type', Integer),
+                             Column('service_id', String),
+                             Column('Latitude', DOUBLE_PRECISION),
+                             Column('Longitude', DOUBLE_PRECISION),
+                             Column('Postal Code', String),
+                             Column('FSA', String))
+
+        borne_recharge = Table('bornes-recharge-publiques-a-jour', metadata,
+                               Column('NOM_BORNE_RECHARGE', String, primary_key=True),
+                               Column('NOM_PARC', String),
+                               Column('ADRESSE', String),
+                               Column('VILLE', String),
+                               Column('NIVEAU_RECHARGE', String),
+                               Column('MODE_TARIFICATION', String),
+                               Column('TYPE_EMPLACEMENT', String),
+                               Column('Longitude', DOUBLE_PRECISION),
+                               Column('Latitude', DOUBLE_PRECISION),
+                               Column('Postal Code', String),
+                               Column('FSA', String))
+
+        stationnement_deneigement = Table('stationnements-h-2023-2024', metadata,
+                                          Column('ID_STA', Integer, primary_key=True),
+                                          Column('ARRONDISSEMENT', String),
+                                          Column('NBR_PLA', Integer),
+                                          Column('JURIDICTION', String),
+                                          Column('EMPLACEMENT', String),
+                                          Column('HEURES', String),
+                                          Column('HOURS', String),
+                                          Column('NOTE_FR', String),
+                                          Column('Latitude', DOUBLE_PRECISION),
+                                          Column('Longitude', DOUBLE_PRECISION),
+                                          Column('Postal Code', String),
+                                          Column('FSA', String))
+
+        # Créer les tables dans la base
+        metadata.create_all(engine)
+        print(f"Les tables ont été créées avec succès dans la base '{POSTGRES_DB}'.")
+
+        return engine, metadata
+    except Exception as e:
+        print("Erreur lors de la création des tables :", e)
+        return None, None
+    finally:
+        if engine:
+            engine.dispose()
+        print("Connexion à la base de données fermée.")
+
+# Fonction pour lire un fichier source en passant par le cache Parquet
+def read_excel_cached(file_path):
+    """
+    Le classeur est converti une seule fois en Parquet dans CACHE_DIR, sous un nom dérivé du hash
+    de son contenu: tant que le fichier ne change pas, les lancements suivants lisent le cache
+    colonnaire (en mémoire mappée) au lieu de ré-analyser le classeur avec openpyxl.
+    """
+    with open(file_path, 'rb') as f:
+        digest = hashlib.file_digest(f, 'sha256').hexdigest()[:16]
+    stem = os.path.splitext(os.path.basename(file_path))[0]
+    cache_path = os.path.join(CACHE_DIR, f"{stem}-{digest}.parquet")
+
+    if os.path.isfile(cache_path):
+        return pd.read_parquet(cache_path, memory_map=True)
+
+    df = pd.read_excel(file_path)
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        for stale in glob.glob(os.path.join(CACHE_DIR, f"{glob.escape(stem)}-*.parquet")):
+            os.remove(stale)
+        df.to_parquet(cache_path, index=False)
+        print(f"Cache Parquet créé pour '{stem}'.")
+    except Exception as e:
+        print(f"Impossible de créer le cache Parquet pour '{stem}' :", e)
+    return df
+
+# Fonction pour charger un DataFrame dans une table avec COPY
+def copy_dataframe(engine, table, df):
+    """
+    Charge le DataFrame dans la table via COPY FROM STDIN, par tranches de COPY_CHUNK_SIZE lignes.
+    La clé primaire est retirée pendant le chargement et recréée une fois toutes les lignes copiées.
+    """
+    df = df.copy()
+    for column in table.columns:
+        # Les colonnes entières avec des valeurs manquantes sont lues comme des floats ("3.0")
+        if isinstance(column.type, Integer) and column.name in df.columns:
+            df[column.name] = df[column.name].astype('Int64')
+
+    columns = ', '.join(f'"{c}"' for c in df.columns)
+    primary_key = ', '.join(f'"{c.name}"' for c in table.primary_key.columns)
+
+    conn = engine.raw_connection()
+    try:
+        cur = conn.cursor()
+        if primary_key:
+            cur.execute(f'ALTER TABLE "{table.name}" DROP CONSTRAINT IF EXISTS "{table.name}_pkey"')
+        for start in range(0, len(df), COPY_CHUNK_SIZE):
+            buffer = io.StringIO()
+            df.iloc[start:start + COPY_CHUNK_SIZE].to_csv(buffer, header=False, index=False)
+            buffer.seek(0)
+            cur.copy_expert(f'COPY "{table.name}" ({columns}) FROM STDIN WITH (FORMAT csv)', buffer)
+        if primary_key:
+            cur.execute(f'ALTER TABLE "{table.name}" ADD PRIMARY KEY ({primary_key})')
+        conn.commit()
+        cur.close()
+    finally:
+        conn.close()
+
+# Fonction pour charger un fichier source dans sa table, exécutée dans son propre processus
+def load_table(metadata, data_dir, filename):
+    """
+    Lit le fichier et le charge dans la table du même nom avec sa propre connexion.
+    Retourne (table, nombre de lignes, durée, erreur); une erreur n'affecte que cette table.
+    """
+    file_wo_ext = os.path.splitext(filename)[0]
+    file_path = os.path.join(data_dir, filename)
+    start = time.perf_counter()
+    engine = None
+    try:
+        if file_wo_ext not in metadata.tables:
+            return file_wo_ext, 0, 0, "aucune table correspondante"
+
+        # Charger les données du fichier CSV ou XLSX
+        if filename.endswith(".csv"):
+            df = pd.read_csv(file_path)
+        else:
+            df = read_excel_cached(file_path)
+
+        # Suppression des colonnes sans nom
+        df = df.loc[:, ~df.columns.str.contains('^Unnamed')]
+
+        engine = create_engine(DB_URL)
+        if LOAD_MODE == 'copy':
+            copy_dataframe(engine, metadata.tables[file_wo_ext], df)
+        else:
+            df.to_sql(file_wo_ext, engine, if_exists='append', index=False)
+        return file_wo_ext, len(df), time.perf_counter() - start, None
+    except Exception as e:
+        return file_wo_ext, 0, time.perf_counter() - start, str(e)
+    finally:
+        if engine:
+            engine.dispose()
+
+# Fonction pour charger les données dans les tables
+def load_data(engine, metadata, data_dir):
+    # Ne garder que les fichiers au format attendu
+    filenames = [f for f in os.listdir(data_dir)
+                 if f.endswith((".csv", ".xlsx")) and os.path.isfile(os.path.join(data_dir, f))]
+    results = []
+    try:
+        with ProcessPoolExecutor(max_workers=max(1, min(LOAD_WORKERS, len(filenames)))) as executor:
+            futures = [executor.submit(load_table, metadata, data_dir, filename) for filename in filenames]
+            for i, future in enumerate(as_completed(futures), 1):
+                table, rows, elapsed, error = future.result()
+                results.append((table, rows, elapsed, error))
+                if error:
+                    print(f"[{i}/{len(filenames)}] Erreur lors de l'importation de '{table}' : {error}")
+                else:
+                    print(f"[{i}/{len(filenames)}] Les données ont été importées dans la table '{table}' ({rows} lignes en {elapsed:.2f} s, {rows / elapsed:.0f} lignes/s).")
+
+    except Exception as e:
+        print("Erreur lors de l'importation des données :", e)
+
+    finally:
+        # Ensure the connection is closed
+        if engine:
+            engine.dispose()
+        print("Connexion à la base de données fermée.")
+
+    loaded = [r for r in results if not r[3]]
+    print(f"Résumé: {len(loaded)}/{len(filenames)} tables chargées, {sum(r[1] for r in loaded)} lignes.")
+    return results
+
+
+# Appel des fonctions principales
+if __name__ == "__main__":
+    engine, metadata = create_database_and_tables()
+    if engine and metadata:
+        load_data(engine, metadata, DATA_DIR)
+        engine.dispose()
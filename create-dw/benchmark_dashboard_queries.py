@@ -0,0 +1,97 @@
+"""
+Compare with EXPLAIN ANALYZE the dashboard queries on db_immo without and with the index
+migrations. The pending migrations are applied first for the "after" plans; the "before" plans
+are measured inside a transaction that reverts the migrations and is rolled back. Reverting
+drops the tables created by the migrations, so the "before" plans read an unindexed temporary
+copy of them.
+
+Utilisation: python benchmark_dashboard_queries.py [répétitions]   (défaut: 5)
+"""
+import json
+import sys
+import migrations
+from create_and_load_dw import connect_to_db
+
+# Queries run by the dashboard pages (streamlit/home.py and streamlit/pages/details.py)
+HOME_QUERY = """
+    SELECT l.*, f.nearest_metro_km, f.chargers_500m, f.chargers_1km, f.snow_parking_places
+    FROM "Logements" l LEFT JOIN logement_features f ON f.url = l.url"""
+DETAILS_SERVICES = {
+    "stationnements": ('SELECT "ARRONDISSEMENT", "NBR_PLA", "JURIDICTION", "EMPLACEMENT", "HEURES", "NOTE_FR", "Postal Code" '
+                       'FROM "stationnements-h-2023-2024" WHERE "FSA" = %(fsa)s LIMIT 2'),
+    "bornes": ('SELECT "NOM_BORNE_RECHARGE", "ADRESSE", "VILLE", "NIVEAU_RECHARGE", "MODE_TARIFICATION", "TYPE_EMPLACEMENT", "Postal Code" '
+               'FROM "bornes-recharge-publiques-a-jour" WHERE "FSA" = %(fsa)s LIMIT 2'),
+    "arrets": 'SELECT "stop_name", "Postal Code" FROM "arrets_metro" WHERE "FSA" = %(fsa)s LIMIT 2',
+    "lignes": 'SELECT "route_name", "headsign", "Postal Code" FROM "ligne_metro" WHERE "FSA" = %(fsa)s LIMIT 2',
+}
+
+QUERIES = {
+    "home: filtres d'accessibilité": (HOME_QUERY + " WHERE f.nearest_metro_km <= %(metro_km)s AND f.chargers_1km >= %(chargers)s"
+                                      " ORDER BY f.nearest_metro_km ASC NULLS LAST"),
+    "home: tri par bornes": HOME_QUERY + " ORDER BY f.chargers_1km DESC NULLS LAST",
+    "details: contexte FSA": ('SELECT (SELECT AVG("price") FROM "Logements" WHERE "fsa" = %(fsa)s) AS avg_price, '
+                              + ', '.join(f"(SELECT COALESCE(json_agg(r), '[]') FROM ({query}) r) AS {name}"
+                                          for name, query in DETAILS_SERVICES.items())),
+}
+
+# Tables created by the migrations, copied without their indexes for the "before" plans
+MIGRATED_TABLES = ["logement_features"]
+
+def parameters(cur):
+    # Most frequent FSA, and a metro / charging station search, as a typical dashboard search
+    cur.execute('SELECT fsa FROM "Logements" GROUP BY fsa ORDER BY count(*) DESC LIMIT 1;')
+    fsa = cur.fetchone()[0]
+    return {'fsa': fsa, 'metro_km': 1.0, 'chargers': 1}
+
+def revert_keeping_data(cur):
+    """Revert the migrations in the current transaction, keeping an unindexed temporary copy of the tables they created."""
+    for table in MIGRATED_TABLES:
+        cur.execute(f"CREATE TEMP TABLE {table}_copy AS SELECT * FROM {table};")
+    migrations.revert(cur, 'db')
+    # Temporary tables come first in the search path: the queries read the copies
+    for table in MIGRATED_TABLES:
+        cur.execute(f"ALTER TABLE {table}_copy RENAME TO {table};")
+
+def explain(cur, params, repetitions):
+    """Return, for each query, its best execution time (ms) and the node types of its plan."""
+    results = {}
+    for label, query in QUERIES.items():
+        times = []
+        for _ in range(repetitions):
+            cur.execute(f"EXPLAIN (ANALYZE, FORMAT JSON) {query}", params)
+            plan = cur.fetchone()[0]
+            if isinstance(plan, str):
+                plan = json.loads(plan)
+            times.append(plan[0]["Execution Time"])
+        results[label] = (min(times), plan_nodes(plan[0]["Plan"]))
+    return results
+
+def plan_nodes(node):
+    nodes = [node["Node Type"] + (f" ({node['Index Name']})" if "Index Name" in node else "")]
+    for child in node.get("Plans", []):
+        nodes += plan_nodes(child)
+    return nodes
+
+if __name__ == "__main__":
+    repetitions = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    conn = connect_to_db()
+    try:
+        # The dashboard queries need the tables created by the migrations
+        migrations.migrate(conn, 'db')
+        with conn.cursor() as cur:
+            params = parameters(cur)
+            after = explain(cur, params, repetitions)
+            conn.rollback()
+
+            revert_keeping_data(cur)
+            before = explain(cur, params, repetitions)
+            conn.rollback()
+    finally:
+        conn.close()
+
+    print(f"Paramètres: {params}")
+    for label in QUERIES:
+        (time_before, plan_before), (time_after, plan_after) = before[label], after[label]
+        print(f"{label}")
+        print(f"  avant: {time_before:9.3f} ms  {' > '.join(plan_before)}")
+        print(f"  après: {time_after:9.3f} ms  {' > '.join(plan_after)}  (x{time_before / max(time_after, 1e-3):.1f})")
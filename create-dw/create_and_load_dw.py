@@ -1,6 +1,9 @@
 from datetime import datetime
 import psycopg2
 import os
+import threading
+import time
+import migrations
 
 POSTGRES_HOST = os.getenv('POSTGRES_HOST')
 POSTGRES_PORT = os.getenv('POSTGRES_PORT')
@@ -8,6 +11,33 @@ POSTGRES_DB = os.getenv('POSTGRES_DB')
 POSTGRES_DW = os.getenv('POSTGRES_DW')
 POSTGRES_USER = os.getenv('POSTGRES_USER')
 POSTGRES_PASSWORD = os.getenv('POSTGRES_PASSWORD')
+DW_BUILD_MODE = os.getenv('DW_BUILD_MODE', 'server')
+DW_REFRESH_MODE = os.getenv('DW_REFRESH_MODE', 'incremental')
+LINK_RADIUS_KM = float(os.getenv('LINK_RADIUS_KM', 1.0))
+LINK_K = int(os.getenv('LINK_K', 5))
+
+# Service layers linked to each listing: (fact column, dimension table, key, latitude, longitude)
+SPATIAL_LAYERS = [
+    ("metro_ligne_id", "dw_dim_lignes_metro", "dw_ligne_id", "latitude", "longitude"),
+    ("metro_arret_id", "dw_dim_arrets_metro", "dw_arrets_id", "latitude", "longitude"),
+    ("borne_id", "dw_dim_bornes_recharge", "nom_borne_recharge", "latitude", "longitude"),
+    ("stationnement_id", "dw_dim_stationnements_deneigement", "id_sta", "latitude", "longitude")
+]
+
+# Natural keys of the dimensions whose rows are updated in place when their source row changes
+DW_CONFLICT_KEYS = {
+    "dw_dim_bornes_recharge": "nom_borne_recharge",
+    "dw_dim_stationnements_deneigement": "id_sta"
+}
+
+# Natural keys of the type 2 dimensions: a changed source row closes the current version and adds a new one
+DW_SCD2_KEYS = {
+    "dw_dim_logements": "url"
+}
+
+# Dimensions without natural key: when their source changes, the DW rows are synchronized with the
+# whole source by comparing complete rows, so that unchanged rows keep their id
+DW_SYNCED_TABLES = ["dw_dim_lignes_metro", "dw_dim_arrets_metro"]
 
 def connect_to_db():
     return psycopg2.connect(
@@ -79,7 +109,31 @@ def create_dw_tables():
             postal_code VARCHAR(255), 
             fsa VARCHAR(255), 
             update_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP, 
-            state VARCHAR(255) DEFAULT 'new');""")
+            state VARCHAR(255) DEFAULT 'new',
+            valid_from TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            valid_to TIMESTAMP,
+            is_current BOOLEAN DEFAULT TRUE);""")
+
+    # Slowly changing dimension (type 2): existing rows get their validity range from the
+    # update dates, the latest row of each url being the current version
+    cur.execute("""
+        ALTER TABLE dw_dim_logements
+            ADD COLUMN IF NOT EXISTS valid_from TIMESTAMP,
+            ADD COLUMN IF NOT EXISTS valid_to TIMESTAMP,
+            ADD COLUMN IF NOT EXISTS is_current BOOLEAN;""")
+    cur.execute("""
+        UPDATE dw_dim_logements d
+        SET valid_from = d.update_date, valid_to = v.next_date, is_current = v.next_date IS NULL
+        FROM (SELECT dw_id, LEAD(update_date) OVER (PARTITION BY url ORDER BY update_date, dw_id) AS next_date
+              FROM dw_dim_logements) v
+        WHERE d.dw_id = v.dw_id AND d.is_current IS NULL;""")
+    cur.execute("""
+        ALTER TABLE dw_dim_logements
+            ALTER COLUMN valid_from SET DEFAULT CURRENT_TIMESTAMP,
+            ALTER COLUMN is_current SET DEFAULT TRUE;""")
+    cur.execute("CREATE UNIQUE INDEX IF NOT EXISTS dw_dim_logements_current_idx ON dw_dim_logements (url) WHERE is_current;")
+    # All the versions of a listing, whose links are dropped when it gets a new one
+    cur.execute("CREATE INDEX IF NOT EXISTS dw_dim_logements_url_idx ON dw_dim_logements (url);")
 
     cur.execute("""
         CREATE TABLE IF NOT EXISTS dw_dim_lignes_metro (
@@ -151,9 +205,90 @@ def create_dw_tables():
             metro_arret_id INT REFERENCES dw_dim_arrets_metro(dw_arrets_id), 
             borne_id TEXT REFERENCES dw_dim_bornes_recharge(nom_borne_recharge), 
             stationnement_id INT REFERENCES dw_dim_stationnements_deneigement(id_sta), 
+            distance_km DOUBLE PRECISION,
             created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
         );
     """)
+    cur.execute("ALTER TABLE dw_fact_logements ADD COLUMN IF NOT EXISTS distance_km DOUBLE PRECISION;")
+
+    # Watermarks of the incremental refresh
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS dw_refresh_state (
+            name VARCHAR(255) PRIMARY KEY,
+            value BIGINT,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP);""")
+    cur.execute("CREATE INDEX IF NOT EXISTS dw_fact_logements_logement_idx ON dw_fact_logements (logement_id);")
+
+    # Append-only price history, one partition per month of update_date
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS fact_price_events (
+            event_id BIGSERIAL,
+            logement_id INT,
+            url VARCHAR(255),
+            fsa VARCHAR(255),
+            price NUMERIC,
+            event_type VARCHAR(255),
+            update_date TIMESTAMP NOT NULL,
+            PRIMARY KEY (event_id, update_date)
+        ) PARTITION BY RANGE (update_date);""")
+    cur.execute("CREATE INDEX IF NOT EXISTS fact_price_events_fsa_idx ON fact_price_events (fsa, update_date);")
+    cur.execute("CREATE INDEX IF NOT EXISTS fact_price_events_logement_idx ON fact_price_events (logement_id);")
+    cur.execute("""
+        CREATE OR REPLACE FUNCTION create_price_events_partition(ts TIMESTAMP) RETURNS VOID AS $$
+        DECLARE
+            month_start DATE := date_trunc('month', ts);
+        BEGIN
+            EXECUTE format('CREATE TABLE IF NOT EXISTS %I PARTITION OF fact_price_events FOR VALUES FROM (%L) TO (%L)',
+                           'fact_price_events_' || to_char(month_start, 'YYYY_MM'), month_start, month_start + INTERVAL '1 month');
+        END;
+        $$ LANGUAGE plpgsql;""")
+
+    # Median price per FSA and day/week, recomputed only for the buckets that received events
+    for rollup, period in [("agg_price_fsa_daily", "day"), ("agg_price_fsa_weekly", "week")]:
+        cur.execute(f"""
+            CREATE TABLE IF NOT EXISTS {rollup} (
+                fsa VARCHAR(255),
+                period_start DATE,
+                median_price NUMERIC,
+                nb_events INT,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (fsa, period_start));""")
+    cur.execute("""
+        CREATE OR REPLACE FUNCTION refresh_price_rollups(from_ts TIMESTAMP, to_ts TIMESTAMP, fsas TEXT[] DEFAULT NULL)
+        RETURNS VOID AS $$
+            INSERT INTO agg_price_fsa_daily (fsa, period_start, median_price, nb_events)
+            SELECT fsa, date_trunc('day', update_date)::DATE,
+                   percentile_cont(0.5) WITHIN GROUP (ORDER BY price::DOUBLE PRECISION), count(*)
+            FROM fact_price_events
+            WHERE update_date >= date_trunc('day', from_ts) AND update_date < date_trunc('day', to_ts) + INTERVAL '1 day'
+              AND price IS NOT NULL AND fsa IS NOT NULL AND (fsas IS NULL OR fsa = ANY(fsas))
+            GROUP BY 1, 2
+            ON CONFLICT (fsa, period_start) DO UPDATE
+            SET median_price = EXCLUDED.median_price, nb_events = EXCLUDED.nb_events, updated_at = CURRENT_TIMESTAMP;
+
+            INSERT INTO agg_price_fsa_weekly (fsa, period_start, median_price, nb_events)
+            SELECT fsa, date_trunc('week', update_date)::DATE,
+                   percentile_cont(0.5) WITHIN GROUP (ORDER BY price::DOUBLE PRECISION), count(*)
+            FROM fact_price_events
+            WHERE update_date >= date_trunc('week', from_ts) AND update_date < date_trunc('week', to_ts) + INTERVAL '1 week'
+              AND price IS NOT NULL AND fsa IS NOT NULL AND (fsas IS NULL OR fsa = ANY(fsas))
+            GROUP BY 1, 2
+            ON CONFLICT (fsa, period_start) DO UPDATE
+            SET median_price = EXCLUDED.median_price, nb_events = EXCLUDED.nb_events, updated_at = CURRENT_TIMESTAMP;
+        $$ LANGUAGE SQL;""")
+
+    # Great-circle distance used to link listings to nearby services
+    cur.execute("""
+        CREATE OR REPLACE FUNCTION haversine_km(lat1 DOUBLE PRECISION, lon1 DOUBLE PRECISION, lat2 DOUBLE PRECISION, lon2 DOUBLE PRECISION)
+        RETURNS DOUBLE PRECISION AS $$
+            SELECT 2 * 6371.0088 * asin(sqrt(
+                power(sin(radians(lat2 - lat1) / 2), 2) +
+                cos(radians(lat1)) * cos(radians(lat2)) * power(sin(radians(lon2 - lon1) / 2), 2)))
+        $$ LANGUAGE SQL IMMUTABLE PARALLEL SAFE;""")
+
+    # Coordinate indexes for the bounding-box pre-filter
+    for _, dw_table, _, latitude, longitude in SPATIAL_LAYERS:
+        cur.execute(f"CREATE INDEX IF NOT EXISTS {dw_table}_coords_idx ON {dw_table} (({latitude}), ({longitude}));")
 
     conn.commit()
     cur.close()
@@ -188,31 +323,190 @@ def insert_data_into_dw(table_name, dw_table_name, rows):
     cur.close()
     conn.close()
 
-def load_fact_logements():
-    """Load data into the fact table dw_fact_logements."""
+def create_load_log():
+    """Create in db_immo the change log of source rows already loaded into the DW, by content hash."""
+    conn = connect_to_db()
+    cur = conn.cursor()
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS dw_load_log (
+            source VARCHAR(255),
+            row_hash CHAR(32),
+            loaded_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (source, row_hash));""")
+    conn.commit()
+    cur.close()
+    conn.close()
+
+def dw_target_columns(dw_cur, dw_table_name, nb_columns):
+    """Return the DW columns receiving the source columns, in order (skipping the SERIAL key)."""
+    dw_cur.execute("""
+        SELECT column_name FROM information_schema.columns
+        WHERE table_schema = current_schema() AND table_name = %s
+        ORDER BY ordinal_position;""", (dw_table_name,))
+    columns = [row[0] for row in dw_cur.fetchall()]
+    offset = 0 if dw_table_name in ["dw_dim_bornes_recharge", "dw_dim_stationnements_deneigement"] else 1
+    return [f'"{c}"' for c in columns[offset:offset + nb_columns]]
+
+def transfer_table(table_name, dw_table_name, incremental=False):
+    """
+    Copy a db_immo table into a DW dimension table without materializing rows in Python:
+    a single INSERT ... SELECT when both live in the same database, otherwise a COPY TO STDOUT
+    from the source streamed through a pipe into a COPY FROM STDIN on the DW.
+    In incremental mode, only source rows whose content hash is not in dw_load_log are copied.
+    For type 2 dimensions, rows identical to the current version are skipped and the current
+    version of each other copied row is closed first. Dimensions without natural key are
+    synchronized with the whole source when it changed: stale rows are removed and only the
+    missing ones are added.
+    Returns the number of rows copied or removed.
+    """
+    src = connect_to_db()
+    dw = connect_to_dw()
+    # Copy and change log must see the same snapshot of the source
+    src.set_session(isolation_level='REPEATABLE READ')
+    dw.set_session(isolation_level='REPEATABLE READ')
+    src_cur = src.cursor()
+    dw_cur = dw.cursor()
+
+    src_cur.execute(f"SELECT * FROM \"{table_name}\" LIMIT 0;")
+    target_columns = dw_target_columns(dw_cur, dw_table_name, len(src_cur.description))
+    columns = ', '.join(target_columns)
+    dw_row = ', '.join(f"d.{c}" for c in target_columns)
+    staged_row = ', '.join(f"s.{c}" for c in target_columns)
+
+    query = f"SELECT t.* FROM \"{table_name}\" t"
+    changed = f"{query} WHERE NOT EXISTS (SELECT 1 FROM dw_load_log g WHERE g.source = %s AND g.row_hash = md5(t::text))"
+    synced = dw_table_name in DW_SYNCED_TABLES
+    if synced and incremental:
+        # Without natural key, a changed or removed source row can only be matched on the whole table
+        src_cur.execute(f"""
+            SELECT EXISTS ({changed}) OR EXISTS (
+                SELECT 1 FROM dw_load_log g WHERE g.source = %s
+                AND NOT EXISTS (SELECT 1 FROM \"{table_name}\" t WHERE md5(t::text) = g.row_hash));""", (table_name, table_name))
+        synced = src_cur.fetchone()[0]
+        if not synced:
+            query += " LIMIT 0"
+    elif incremental:
+        query = src_cur.mogrify(changed, (table_name,)).decode()
+
+    conflict = ""
+    if dw_table_name in DW_CONFLICT_KEYS:
+        updates = ', '.join(f"{c} = EXCLUDED.{c}" for c in target_columns)
+        conflict = f" ON CONFLICT ({DW_CONFLICT_KEYS[dw_table_name]}) DO UPDATE SET {updates}"
+    scd2_key = DW_SCD2_KEYS.get(dw_table_name)
+
+    # Upserts, versions and synchronization compare the source rows with the DW: stage them first
+    staged = conflict or scd2_key or dw_table_name in DW_SYNCED_TABLES
+    if staged:
+        dw_cur.execute(f"CREATE TEMP TABLE staging ON COMMIT DROP AS SELECT {columns} FROM {dw_table_name} WITH NO DATA;")
+    copy_target = "staging" if staged else dw_table_name
+
+    same_database = src.get_dsn_parameters()['dbname'] == dw.get_dsn_parameters()['dbname']
+    if same_database:
+        dw_cur.execute(f"INSERT INTO {copy_target} ({columns}) {query};")
+    else:
+        read_fd, write_fd = os.pipe()
+        with os.fdopen(read_fd, 'rb') as reader, os.fdopen(write_fd, 'wb') as writer:
+            def produce():
+                try:
+                    src_cur.copy_expert(f"COPY ({query}) TO STDOUT;", writer)
+                finally:
+                    writer.close()
+            producer = threading.Thread(target=produce)
+            producer.start()
+            dw_cur.copy_expert(f"COPY {copy_target} ({columns}) FROM STDIN;", reader)
+            producer.join()
+    rows = dw_cur.rowcount
+
+    if staged:
+        removed = 0
+        if scd2_key:
+            # A row already versioned with these values (e.g. by the update job) is not a new version
+            dw_cur.execute(f"""
+                DELETE FROM staging s USING {dw_table_name} d
+                WHERE d.is_current AND d.{scd2_key} = s.{scd2_key} AND ({dw_row}) IS NOT DISTINCT FROM ({staged_row});""")
+            dw_cur.execute(f"""
+                UPDATE {dw_table_name} d SET valid_to = CURRENT_TIMESTAMP, is_current = FALSE
+                WHERE d.is_current AND d.{scd2_key} IN (SELECT s.{scd2_key} FROM staging s);""")
+        if synced:
+            fact_column, key = next((layer[0], layer[2]) for layer in SPATIAL_LAYERS if layer[1] == dw_table_name)
+            stale = (f"SELECT d.{key} FROM {dw_table_name} d "
+                     f"WHERE NOT EXISTS (SELECT 1 FROM staging s WHERE ({staged_row}) IS NOT DISTINCT FROM ({dw_row}))")
+            dw_cur.execute(f"DELETE FROM dw_fact_logements WHERE {fact_column} IN ({stale});")
+            dw_cur.execute(f"DELETE FROM {dw_table_name} WHERE {key} IN ({stale});")
+            removed = dw_cur.rowcount
+            dw_cur.execute(f"""
+                DELETE FROM staging s
+                WHERE EXISTS (SELECT 1 FROM {dw_table_name} d WHERE ({dw_row}) IS NOT DISTINCT FROM ({staged_row}));""")
+        dw_cur.execute(f"INSERT INTO {dw_table_name} ({columns}) SELECT * FROM staging{conflict};")
+        rows = dw_cur.rowcount + removed
+
+    # Record the loaded rows and forget the ones that left the source
+    log_cur = dw_cur if same_database else src_cur
+    log_cur.execute(f"INSERT INTO dw_load_log (source, row_hash) SELECT DISTINCT %s, md5(t::text) FROM \"{table_name}\" t ON CONFLICT DO NOTHING;", (table_name,))
+    log_cur.execute(f"DELETE FROM dw_load_log g WHERE g.source = %s AND NOT EXISTS (SELECT 1 FROM \"{table_name}\" t WHERE md5(t::text) = g.row_hash);", (table_name,))
+
+    dw.commit()
+    src.commit()
+    src_cur.close()
+    dw_cur.close()
+    src.close()
+    dw.close()
+    return rows
+
+def load_fact_logements(incremental=False):
+    """
+    Load data into the fact table dw_fact_logements: one row per (listing, nearby service),
+    keeping for each service layer the LINK_K nearest points within LINK_RADIUS_KM, with their
+    distance. Candidates are pre-filtered with an indexed latitude/longitude bounding box before
+    computing the haversine distance. Only the current version of each listing still for sale is
+    linked, so the fact table grows linearly with the listings, not with their versions.
+    In incremental mode, only versions added since the last load (dw_id above the watermark)
+    are linked, and the links of the versions they replaced are dropped; otherwise the fact
+    table is rebuilt.
+    """
     conn = connect_to_dw()
     cur = conn.cursor()
 
-    # Prepare fact table data by joining dimension tables
-    cur.execute("""
-        INSERT INTO dw_fact_logements (logement_id, metro_ligne_id, metro_arret_id, borne_id, stationnement_id)
-        SELECT 
-            l.dw_id AS logement_id,
-            lm.dw_ligne_id AS metro_ligne_id,
-            am.dw_arrets_id AS metro_arret_id,
-            br.nom_borne_recharge AS borne_id,
-            sd.id_sta AS stationnement_id
-        FROM 
-            dw_dim_logements l
-        LEFT JOIN dw_dim_lignes_metro lm 
-            ON l.postal_code = lm."Postal Code"  -- Relate based on postal code
-        LEFT JOIN dw_dim_arrets_metro am 
-            ON l.latitude = am.latitude::DOUBLE PRECISION AND l.longitude = am.longitude::DOUBLE PRECISION -- Explicit type cast
-        LEFT JOIN dw_dim_bornes_recharge br 
-            ON l.postal_code = br."Postal Code"  -- Relate based on postal code
-        LEFT JOIN dw_dim_stationnements_deneigement sd 
-            ON l.postal_code = sd."Postal Code";  -- Relate based on postal code
-    """)
+    cur.execute("SELECT COALESCE(MAX(dw_id), 0) FROM dw_dim_logements;")
+    until = cur.fetchone()[0]
+    since = 0
+    if incremental:
+        cur.execute("SELECT value FROM dw_refresh_state WHERE name = 'fact_logements';")
+        row = cur.fetchone()
+        since = row[0] if row else 0
+        # Versions closed or sold by the versions added since the last load
+        cur.execute("""
+            DELETE FROM dw_fact_logements f USING dw_dim_logements l
+            WHERE f.logement_id = l.dw_id AND (NOT l.is_current OR l.state = 'sold')
+              AND l.url IN (SELECT url FROM dw_dim_logements WHERE dw_id > %s AND dw_id <= %s);""", (since, until))
+        print(f"{cur.rowcount} liens de versions remplacées supprimés.")
+    else:
+        cur.execute("DELETE FROM dw_fact_logements;")
+
+    for fact_column, dw_table, key, latitude, longitude in SPATIAL_LAYERS:
+        cur.execute(f"""
+            INSERT INTO dw_fact_logements (logement_id, {fact_column}, distance_km)
+            SELECT l.dw_id, n.{key}, n.distance_km
+            FROM dw_dim_logements l
+            CROSS JOIN LATERAL (
+                SELECT s.{key}, haversine_km(l.latitude, l.longitude, s.{latitude}, s.{longitude}) AS distance_km
+                FROM {dw_table} s
+                WHERE s.{latitude} BETWEEN l.latitude - %(dlat)s AND l.latitude + %(dlat)s
+                  AND s.{longitude} BETWEEN l.longitude - %(dlat)s / cos(radians(l.latitude))
+                                        AND l.longitude + %(dlat)s / cos(radians(l.latitude))
+                  AND haversine_km(l.latitude, l.longitude, s.{latitude}, s.{longitude}) <= %(radius)s
+                ORDER BY distance_km
+                LIMIT %(k)s
+            ) n
+            WHERE l.latitude IS NOT NULL AND l.longitude IS NOT NULL
+              AND l.is_current AND l.state IS DISTINCT FROM 'sold'
+              AND l.dw_id > %(since)s AND l.dw_id <= %(until)s;
+        """, {'dlat': LINK_RADIUS_KM / 111.045, 'radius': LINK_RADIUS_KM, 'k': LINK_K, 'since': since, 'until': until})
+        print(f"{cur.rowcount} liens créés vers {dw_table}.")
+
+    cur.execute("""
+        INSERT INTO dw_refresh_state (name, value) VALUES ('fact_logements', %s)
+        ON CONFLICT (name) DO UPDATE SET value = EXCLUDED.value, updated_at = CURRENT_TIMESTAMP;""", (until,))
 
     conn.commit()
     cur.close()
@@ -220,28 +514,102 @@ def load_fact_logements():
 
     print("Les données ont été chargées dans la table de faits 'dw_fact_logements'.")
 
+def load_price_events():
+    """
+    Append to fact_price_events the listing versions added to dw_dim_logements since the last run
+    and not recorded yet (the update job records its own), then refresh the rollups of the days
+    and weeks that received events.
+    """
+    conn = connect_to_dw()
+    cur = conn.cursor()
+
+    cur.execute("SELECT COALESCE(MAX(dw_id), 0) FROM dw_dim_logements;")
+    until = cur.fetchone()[0]
+    cur.execute("SELECT value FROM dw_refresh_state WHERE name = 'price_events';")
+    row = cur.fetchone()
+    since = row[0] if row else 0
+
+    cur.execute("""
+        SELECT DISTINCT date_trunc('month', update_date) FROM dw_dim_logements
+        WHERE dw_id > %s AND dw_id <= %s AND update_date IS NOT NULL;""", (since, until))
+    for (month,) in cur.fetchall():
+        cur.execute("SELECT create_price_events_partition(%s);", (month,))
+
+    cur.execute("""
+        WITH e AS (
+            INSERT INTO fact_price_events (logement_id, url, fsa, price, event_type, update_date)
+            SELECT l.dw_id, l.url, l.fsa, l.price, l.state, l.update_date
+            FROM dw_dim_logements l
+            WHERE l.dw_id > %s AND l.dw_id <= %s AND l.update_date IS NOT NULL
+              AND NOT EXISTS (SELECT 1 FROM fact_price_events f WHERE f.logement_id = l.dw_id)
+            ORDER BY l.dw_id
+            RETURNING fsa, update_date
+        )
+        SELECT count(*), MIN(update_date), MAX(update_date), array_agg(DISTINCT fsa) FROM e;""", (since, until))
+    nb_events, first, last, fsas = cur.fetchone()
+    if nb_events:
+        cur.execute("SELECT refresh_price_rollups(%s, %s, %s);", (first, last, fsas))
+
+    cur.execute("""
+        INSERT INTO dw_refresh_state (name, value) VALUES ('price_events', %s)
+        ON CONFLICT (name) DO UPDATE SET value = EXCLUDED.value, updated_at = CURRENT_TIMESTAMP;""", (until,))
+
+    conn.commit()
+    cur.close()
+    conn.close()
+    print(f"{nb_events} événements de prix ajoutés à 'fact_price_events'.")
+
+def apply_migrations():
+    """Apply the pending schema migrations of db_immo and of the Data Warehouse."""
+    for connect, database in [(connect_to_db, 'db'), (connect_to_dw, 'dw')]:
+        conn = connect()
+        try:
+            migrations.migrate(conn, database)
+        finally:
+            conn.close()
+    print("Les migrations du schéma sont à jour.")
+
 def load_data():
     """Load data into the Data Warehouse."""
-    
-    logements = fetch_table_data("Logements")
-    insert_data_into_dw("Logements", "dw_dim_logements", logements)
-    
-    lignes_metro = fetch_table_data("ligne_metro")
-    insert_data_into_dw("ligne_metro", "dw_dim_lignes_metro", lignes_metro)
-    
-    arrets_metro = fetch_table_data("arrets_metro")
-    insert_data_into_dw("arrets_metro", "dw_dim_arrets_metro", arrets_metro)
-    
-    bornes_recharge = fetch_table_data("bornes-recharge-publiques-a-jour")
-    insert_data_into_dw("bornes-recharge-publiques-a-jour", "dw_dim_bornes_recharge", bornes_recharge)
-    
-    stationnements = fetch_table_data("stationnements-h-2023-2024")
-    insert_data_into_dw("stationnements-h-2023-2024", "dw_dim_stationnements_deneigement", stationnements)
-    
-    load_fact_logements()
-    print("Les données ont été bien enregistrées dans les tables de faits et dimensions.")
+    tables = [
+        ("Logements", "dw_dim_logements"),
+        ("ligne_metro", "dw_dim_lignes_metro"),
+        ("arrets_metro", "dw_dim_arrets_metro"),
+        ("bornes-recharge-publiques-a-jour", "dw_dim_bornes_recharge"),
+        ("stationnements-h-2023-2024", "dw_dim_stationnements_deneigement")
+    ]
+
+    # The incremental refresh relies on the server-side transfer and its change log
+    incremental = DW_BUILD_MODE == 'server' and DW_REFRESH_MODE == 'incremental'
+    if DW_BUILD_MODE == 'server':
+        create_load_log()
+
+    build_start = time.perf_counter()
+    services_changed = False
+    for table_name, dw_table_name in tables:
+        start = time.perf_counter()
+        if DW_BUILD_MODE == 'server':
+            nb_rows = transfer_table(table_name, dw_table_name, incremental)
+        else:
+            rows = fetch_table_data(table_name)
+            insert_data_into_dw(table_name, dw_table_name, rows)
+            nb_rows = len(rows)
+        if dw_table_name != "dw_dim_logements" and nb_rows:
+            services_changed = True
+        print(f"{dw_table_name}: {nb_rows} lignes chargées en {time.perf_counter() - start:.2f} s ({DW_BUILD_MODE}).")
+
+    # New service points can change the links of every listing
+    start = time.perf_counter()
+    load_fact_logements(incremental and not services_changed)
+    print(f"dw_fact_logements chargée en {time.perf_counter() - start:.2f} s.")
+
+    start = time.perf_counter()
+    load_price_events()
+    print(f"fact_price_events chargée en {time.perf_counter() - start:.2f} s.")
+    print(f"Les données ont été bien enregistrées dans les tables de faits et dimensions ({time.perf_counter() - build_start:.2f} s).")
 
 if __name__ == "__main__":
     create_dw_database()
     create_dw_tables()
+    apply_migrations()
     load_data()
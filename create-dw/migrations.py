@@ -0,0 +1,107 @@
+"""
+Versioned schema migrations of the operational database (db_immo) and of the Data Warehouse.
+
+Each migration targets one database ('db' or 'dw'), is applied once, in version order, in its own
+transaction, and is recorded in the schema_migrations table of that database. Versions are unique
+across both databases, so the two sets can share one schema_migrations table when the DW lives in
+db_immo. The down statements undo a migration; they are only used by the query benchmark.
+"""
+from collections import namedtuple
+
+Migration = namedtuple("Migration", ["version", "database", "description", "up", "down"])
+
+SERVICE_TABLES = ["stationnements-h-2023-2024", "bornes-recharge-publiques-a-jour", "arrets_metro", "ligne_metro"]
+
+def numeric(column):
+    # Values that are not plain decimal numbers (e.g. '12.5.3') become NULL instead of aborting the migration
+    return f"CASE WHEN {column} ~ '^[0-9]+(\\.[0-9]+)?$' THEN {column}::NUMERIC END"
+
+MIGRATIONS = [
+    Migration(1, 'dw', "Numeric living_area and land_area in dw_dim_logements",
+              [f"ALTER TABLE dw_dim_logements ALTER COLUMN living_area TYPE NUMERIC USING {numeric('living_area')}, "
+               f"ALTER COLUMN land_area TYPE NUMERIC USING {numeric('land_area')};"],
+              ["ALTER TABLE dw_dim_logements ALTER COLUMN living_area TYPE VARCHAR(255), ALTER COLUMN land_area TYPE VARCHAR(255);"]),
+
+    Migration(2, 'dw', "Double precision coordinates in the metro dimensions",
+              [f"ALTER TABLE {table} ALTER COLUMN latitude TYPE DOUBLE PRECISION USING NULLIF(latitude, '')::DOUBLE PRECISION, "
+               f"ALTER COLUMN longitude TYPE DOUBLE PRECISION USING NULLIF(longitude, '')::DOUBLE PRECISION;"
+               for table in ["dw_dim_lignes_metro", "dw_dim_arrets_metro"]],
+              [f"ALTER TABLE {table} ALTER COLUMN latitude TYPE VARCHAR(255), ALTER COLUMN longitude TYPE VARCHAR(255);"
+               for table in ["dw_dim_lignes_metro", "dw_dim_arrets_metro"]]),
+
+    Migration(3, 'db', "Indexes for the dashboard filters on Logements",
+              ['CREATE INDEX IF NOT EXISTS logements_fsa_price_idx ON "Logements" (fsa, price);',
+               'CREATE INDEX IF NOT EXISTS logements_price_idx ON "Logements" (price);',
+               'CREATE INDEX IF NOT EXISTS logements_filters_idx ON "Logements" (bedrooms, parking_spaces, price);'],
+              ['DROP INDEX IF EXISTS logements_fsa_price_idx;',
+               'DROP INDEX IF EXISTS logements_price_idx;',
+               'DROP INDEX IF EXISTS logements_filters_idx;']),
+
+    Migration(4, 'db', "FSA indexes on the service tables",
+              [f'CREATE INDEX IF NOT EXISTS "{table}_fsa_idx" ON "{table}" ("FSA");' for table in SERVICE_TABLES],
+              [f'DROP INDEX IF EXISTS "{table}_fsa_idx";' for table in SERVICE_TABLES]),
+
+    Migration(5, 'db', "Accessibility features of the listings",
+              ["""CREATE TABLE IF NOT EXISTS logement_features (
+                      url VARCHAR PRIMARY KEY,
+                      nearest_metro_km DOUBLE PRECISION,
+                      chargers_500m INT,
+                      chargers_1km INT,
+                      snow_parking_places INT,
+                      updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP);""",
+               'CREATE INDEX IF NOT EXISTS logement_features_metro_idx ON logement_features (nearest_metro_km);',
+               'CREATE INDEX IF NOT EXISTS logement_features_chargers_idx ON logement_features (chargers_1km);',
+               'CREATE INDEX IF NOT EXISTS logement_features_parking_idx ON logement_features (snow_parking_places);']
+              + [f'CREATE INDEX IF NOT EXISTS "{table}_coords_idx" ON "{table}" ("Latitude", "Longitude");' for table in SERVICE_TABLES],
+              ['DROP TABLE IF EXISTS logement_features;']
+              + [f'DROP INDEX IF EXISTS "{table}_coords_idx";' for table in SERVICE_TABLES]),
+]
+
+# Serializes concurrent runs of the migrations on the same database
+MIGRATION_LOCK = 4242
+
+def create_migrations_table(cur):
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            version INT PRIMARY KEY,
+            description VARCHAR(255),
+            applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP);""")
+
+def applied_versions(cur):
+    cur.execute("SELECT version FROM schema_migrations;")
+    return {row[0] for row in cur.fetchall()}
+
+def pending_migrations(conn, database):
+    """Return the migrations of the database that are not applied yet, in version order."""
+    with conn.cursor() as cur:
+        create_migrations_table(cur)
+        conn.commit()
+        applied = applied_versions(cur)
+    return [m for m in sorted(MIGRATIONS) if m.database == database and m.version not in applied]
+
+def migrate(conn, database):
+    """Apply the pending migrations of the database ('db' or 'dw'). Returns the applied versions."""
+    applied = []
+    for migration in pending_migrations(conn, database):
+        with conn.cursor() as cur:
+            cur.execute("SELECT pg_advisory_xact_lock(%s);", (MIGRATION_LOCK,))
+            # Another run may have applied it while we waited for the lock
+            if migration.version in applied_versions(cur):
+                conn.rollback()
+                continue
+            for statement in migration.up:
+                cur.execute(statement)
+            cur.execute("INSERT INTO schema_migrations (version, description) VALUES (%s, %s);",
+                        (migration.version, migration.description))
+        conn.commit()
+        applied.append(migration.version)
+        print(f"Migration {migration.version} appliquée: {migration.description}.")
+    return applied
+
+def revert(cur, database):
+    """Undo, in the current transaction, the applied migrations of the database, newest first."""
+    applied = applied_versions(cur)
+    for migration in sorted(MIGRATIONS, reverse=True):
+        if migration.database == database and migration.version in applied:
+            for statement in migration.down:
+                cur.execute(statement)
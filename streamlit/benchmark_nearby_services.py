@@ -0,0 +1,57 @@
+"""
+Compare la recherche des services à proximité de la page Statistics: l'ancienne boucle
+iterrows() + geopy.geodesic contre l'index spatial partagé (BallTree haversine), sur des
+bornes et stationnements synthétiques autour de Montréal.
+
+Utilisation: python benchmark_nearby_services.py [nombre de points ...]   (défaut: 10000 100000)
+"""
+import importlib.util
+import sys
+import time
+import numpy as np
+import pandas as pd
+from geopy.distance import geodesic
+from spatial_index import SpatialIndex
+
+spec = importlib.util.spec_from_file_location("statistics_page", "pages/Statistics.py")
+statistics_page = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(statistics_page)
+
+LOGEMENT = (45.5231, -73.5817)
+RADIUS_KM = 5
+
+def synthetic_services(n: int, seed: int) -> pd.DataFrame:
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame({'Latitude': rng.uniform(45.40, 45.70, n), 'Longitude': rng.uniform(-73.95, -73.45, n)})
+
+def iterrows_geodesic(lat, lon, distance_km, bornes_recharge, stationnements):
+    nearby_services = []
+    for service_type, services in [("Borne de recharge", bornes_recharge), ("Stationnement", stationnements)]:
+        for _, row in services.iterrows():
+            service_distance = geodesic((lat, lon), (row["Latitude"], row["Longitude"])).km
+            if service_distance <= distance_km:
+                nearby_services.append({"type": service_type, "lat": row["Latitude"], "lon": row["Longitude"], "distance": service_distance})
+    return nearby_services
+
+def timed(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - start
+
+if __name__ == "__main__":
+    sizes = [int(n) for n in sys.argv[1:]] or [10000, 100000]
+    for n in sizes:
+        # La moitié des points dans chaque service
+        bornes, stationnements = synthetic_services(n // 2, 0), synthetic_services(n - n // 2, 1)
+        reference, reference_time = timed(iterrows_geodesic, *LOGEMENT, RADIUS_KM, bornes, stationnements)
+        index, build_time = timed(SpatialIndex, {"bornes": bornes, "stationnements": stationnements})
+        result, elapsed = timed(statistics_page.find_nearby_services, *LOGEMENT, RADIUS_KM, index)
+
+        # geodesic (ellipsoïde) et haversine (sphère) peuvent différer de quelques mètres au bord du rayon
+        expected = {(s["type"], s["lat"], s["lon"]): s["distance"] for s in reference}
+        found = {(s["type"], s["lat"], s["lon"]): s["distance"] for s in result}
+        gap = max((abs(expected[key] - found[key]) for key in expected.keys() & found.keys()), default=0)
+        print(f"{n} points: {len(result)} services dans {RADIUS_KM} km")
+        print(f"  iterrows + geodesic: {reference_time * 1000:9.1f} ms")
+        print(f"  index spatial:       {elapsed * 1000:9.1f} ms  (x{reference_time / elapsed:.0f}, construction: {build_time * 1000:.1f} ms)")
+        print(f"  différences au bord du rayon: {len(expected.keys() ^ found.keys())}, écart de distance max: {gap * 1000:.1f} m")
@@ -0,0 +1,64 @@
+"""
+Accès partagé à la base de données pour toutes les pages du tableau de bord: un seul moteur
+SQLAlchemy par processus (st.cache_resource), avec un pool de connexions borné, des requêtes
+paramétrées et des compteurs d'utilisation du pool.
+"""
+import os
+import threading
+import pandas as pd
+import streamlit as st
+from sqlalchemy import create_engine, event, text
+
+POSTGRES_HOST = os.getenv('POSTGRES_HOST')
+POSTGRES_PORT = os.getenv('POSTGRES_PORT')
+POSTGRES_DB = os.getenv('POSTGRES_DB')
+POSTGRES_USER = os.getenv('POSTGRES_USER')
+POSTGRES_PASSWORD = os.getenv('POSTGRES_PASSWORD')
+DB_URL = f"postgresql+psycopg2://{POSTGRES_USER}:{POSTGRES_PASSWORD}@{POSTGRES_HOST}:{POSTGRES_PORT}/{POSTGRES_DB}"
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', 5))
+DB_MAX_OVERFLOW = int(os.getenv('DB_MAX_OVERFLOW', 5))
+DB_POOL_RECYCLE = int(os.getenv('DB_POOL_RECYCLE', 1800))
+
+# Compteurs cumulés depuis la création du moteur
+pool_counters = {"connections": 0, "checkouts": 0, "invalidations": 0}
+pool_counters_lock = threading.Lock()
+
+def count(name):
+    def listener(*args):
+        with pool_counters_lock:
+            pool_counters[name] += 1
+    return listener
+
+@st.cache_resource
+def get_engine():
+    """Moteur unique du processus: les reruns des pages réutilisent les connexions du pool."""
+    engine = create_engine(DB_URL, pool_size=DB_POOL_SIZE, max_overflow=DB_MAX_OVERFLOW,
+                           pool_pre_ping=True, pool_recycle=DB_POOL_RECYCLE)
+    event.listen(engine, "connect", count("connections"))
+    event.listen(engine, "checkout", count("checkouts"))
+    event.listen(engine, "invalidate", count("invalidations"))
+    return engine
+
+def read_sql(query: str, params: dict = None) -> pd.DataFrame:
+    """Exécute une requête avec des paramètres liés (:nom), jamais interpolés dans le SQL."""
+    with get_engine().connect() as conn:
+        return pd.read_sql(text(query), conn, params=params)
+
+def pool_metrics() -> dict:
+    pool = get_engine().pool
+    with pool_counters_lock:
+        counters = dict(pool_counters)
+    return {
+        "Taille du pool": pool.size(),
+        "Connexions utilisées": pool.checkedout(),
+        "Connexions libres": pool.checkedin(),
+        "Débordement": pool.overflow(),
+        "Connexions ouvertes (total)": counters["connections"],
+        "Emprunts (total)": counters["checkouts"],
+        "Connexions invalidées": counters["invalidations"],
+    }
+
+def display_pool_metrics():
+    with st.sidebar.expander("Pool de connexions"):
+        for label, value in pool_metrics().items():
+            st.write(f"{label} : {value}")
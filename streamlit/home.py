@@ -1,28 +1,41 @@
 import streamlit as st
-from sqlalchemy import create_engine
 import pandas as pd
 from babel.numbers import format_currency
-import os
+from db import read_sql, display_pool_metrics
 
 def amt(amount):
     return format_currency(amount, "CAD", "#,##0 ¤", "fr_CA", False)
 
-POSTGRES_HOST = os.getenv('POSTGRES_HOST')
-POSTGRES_PORT = os.getenv('POSTGRES_PORT')
-POSTGRES_DB = os.getenv('POSTGRES_DB')
-POSTGRES_USER = os.getenv('POSTGRES_USER')
-POSTGRES_PASSWORD = os.getenv('POSTGRES_PASSWORD')
-db_url = f"postgresql+psycopg2://{POSTGRES_USER}:{POSTGRES_PASSWORD}@{POSTGRES_HOST}:{POSTGRES_PORT}/{POSTGRES_DB}"
-        
-engine = create_engine(db_url)
+# Options de tri: (colonne, ordre croissant)
+SORT_OPTIONS = {
+    "Aucun": None,
+    "Métro le plus proche": ("nearest_metro_km", True),
+    "Bornes de recharge à 1 km": ("chargers_1km", False),
+    "Stationnements de déneigement": ("snow_parking_places", False),
+}
 
 # Function to load data
 @st.cache_data
-def load_data():
-    query = "SELECT * FROM \"Logements\""
-    with engine.connect() as conn:
-        df = pd.read_sql(query, conn)
-    return df
+def load_data(metro_km=0.0, chargers=0, sort_by="Aucun"):
+    # Indicateurs d'accessibilité précalculés (NULL tant qu'ils n'ont pas été calculés). Leurs filtres
+    # et leur tri sont faits par PostgreSQL, sur les index de logement_features (0 = pas de filtre)
+    query = """
+        SELECT l.*, f.nearest_metro_km, f.chargers_500m, f.chargers_1km, f.snow_parking_places
+        FROM "Logements" l LEFT JOIN logement_features f ON f.url = l.url
+    """
+    conditions, params = [], {}
+    if metro_km > 0:
+        conditions.append("f.nearest_metro_km <= :metro_km")
+        params["metro_km"] = metro_km
+    if chargers > 0:
+        conditions.append("f.chargers_1km >= :chargers")
+        params["chargers"] = chargers
+    if conditions:
+        query += " WHERE " + " AND ".join(conditions)
+    if SORT_OPTIONS[sort_by]:
+        column, ascending = SORT_OPTIONS[sort_by]
+        query += f" ORDER BY f.{column} {'ASC' if ascending else 'DESC'} NULLS LAST"
+    return read_sql(query, params)
 
 # Function to set up session state
 def initialize_session_state():
@@ -30,7 +43,7 @@ def initialize_session_state():
         st.session_state.page = "home"
 
 # Function to display the home page
-def display_home_page(data):
+def display_home_page():
     # Page title
     st.markdown("<h1 style='text-align: center; color: #4CAF50;'>Annonces immobilières</h1>", unsafe_allow_html=True)
 
@@ -47,6 +60,19 @@ def display_home_page(data):
     with col3:
         bedrooms = st.number_input("Chambres", min_value=0, value=0)
 
+    col4, col5, col6 = st.columns([2, 1, 1])
+
+    with col4:
+        sort_by = st.selectbox("Trier par", list(SORT_OPTIONS.keys()))
+
+    with col5:
+        metro_km = st.number_input("Métro à moins de (km)", min_value=0.0, value=0.0, step=0.5)
+
+    with col6:
+        chargers = st.number_input("Bornes à moins de 1 km", min_value=0, value=0, step=1)
+
+    data = load_data(metro_km, chargers, sort_by)
+
     # Apply filters to data
     filtered_data = data[
         (data["price"] >= prices[0]) &
@@ -87,6 +113,7 @@ def display_filtered_data(filtered_data):
                         </a>
                         <div>{amt(annonce['price'])}</div>
                         <div>{int(annonce['bedrooms'])} chambres, {int(annonce['bathrooms'])} salles de bain</div>
+                        <div>{f"Métro à {annonce['nearest_metro_km']:.1f} km" if pd.notna(annonce.get('nearest_metro_km')) else ""}</div>
                     </div>
                 """, unsafe_allow_html=True)
                 if st.button(f"Voir les détails", key=f"details_{i}_{j}"):
@@ -99,13 +126,11 @@ def display_filtered_data(filtered_data):
 def main():
     # Initialize session state
     initialize_session_state()
-    # Load data
-    data = load_data()
-
+    display_pool_metrics()
 
     # Display content based on the current page in session state
     if st.session_state.page == "home":
-        display_home_page(data)
+        display_home_page()
     elif st.session_state.page == "details":
         st.stop()
 
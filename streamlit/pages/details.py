@@ -1,5 +1,4 @@
 import streamlit as st
-from sqlalchemy import create_engine
 import pandas as pd
 import pydeck as pdk
 import matplotlib.pyplot as plt
@@ -9,32 +8,50 @@ import base64
 import os
 # from streamlit.home import initialize_session_state
 from babel.numbers import format_currency
+from db import read_sql
+from spatial_index import get_spatial_index
 
 def amt(amount):
     return format_currency(amount, "CAD", "#,##0 ¤", "fr_CA", False)
 
-POSTGRES_HOST = os.getenv('POSTGRES_HOST')
-POSTGRES_PORT = os.getenv('POSTGRES_PORT')
-POSTGRES_DB = os.getenv('POSTGRES_DB')
-POSTGRES_USER = os.getenv('POSTGRES_USER')
-POSTGRES_PASSWORD = os.getenv('POSTGRES_PASSWORD')
-DB_URL = f"postgresql+psycopg2://{POSTGRES_USER}:{POSTGRES_PASSWORD}@{POSTGRES_HOST}:{POSTGRES_PORT}/{POSTGRES_DB}"
-engine = create_engine(DB_URL)
+MAP_RADIUS_KM = float(os.getenv('MAP_RADIUS_KM', 1.0))
+DETAIL_CACHE_TTL = int(os.getenv('DETAIL_CACHE_TTL', 600))
+
+# Services de la FSA affichés dans les informations complémentaires
+RELATED_QUERIES = {
+    "Stationnements": '''
+        SELECT "ARRONDISSEMENT", "NBR_PLA", "JURIDICTION", "EMPLACEMENT", "HEURES", "NOTE_FR", "Postal Code"
+        FROM "stationnements-h-2023-2024" WHERE "FSA" = :fsa LIMIT 2
+    ''',
+    "Bornes de Recharge": '''
+        SELECT "NOM_BORNE_RECHARGE", "ADRESSE", "VILLE", "NIVEAU_RECHARGE", "MODE_TARIFICATION", "TYPE_EMPLACEMENT", "Postal Code"
+        FROM "bornes-recharge-publiques-a-jour" WHERE "FSA" = :fsa LIMIT 2
+    ''',
+    "Arrêts de Métro": '''
+        SELECT "stop_name", "Postal Code" FROM "arrets_metro" WHERE "FSA" = :fsa LIMIT 2
+    ''',
+    "Lignes de Métro": '''
+        SELECT "route_name", "headsign", "Postal Code" FROM "ligne_metro" WHERE "FSA" = :fsa LIMIT 2
+    '''
+}
+
+# Function to fetch everything the detail page needs for an FSA in a single round trip
+@st.cache_data(ttl=DETAIL_CACHE_TTL, show_spinner=False)
+def load_fsa_context(fsa):
+    # Each service query is aggregated into a JSON column of the same row
+    services = ",\n".join(f'(SELECT COALESCE(json_agg(r), \'[]\') FROM ({query}) r) AS "{title}"'
+                           for title, query in RELATED_QUERIES.items())
+    query = f'SELECT (SELECT AVG("price") FROM "Logements" WHERE "fsa" = :fsa) AS avg_price,\n{services}'
+    row = read_sql(query, {"fsa": fsa}).iloc[0]
+    return {"avg_price": row["avg_price"], **{title: pd.DataFrame(row[title]) for title in RELATED_QUERIES}}
 
 # Function to display property details
 def display_annonce_details(annonce):
     # Generate Visualization (Example: Comparison of living area and land area)
     def generate_price_comparison(fsa, current_price):
-        # Query to get the average price of properties in the same FSA
-        query = f"""
-        SELECT AVG("price") as avg_price
-        FROM "Logements"
-        WHERE "fsa" = '{fsa}'
-        """
+        # Average price of properties in the same FSA
         try:
-            with engine.connect() as conn:
-                avg_price_data = pd.read_sql(query, conn)
-                avg_price = avg_price_data["avg_price"].iloc[0] if not avg_price_data.empty else 0
+            avg_price = load_fsa_context(fsa)["avg_price"]
         except Exception as e:
             st.error(f"Erreur lors de la récupération du prix moyen pour l'FSA: {e}")
             avg_price = 0
@@ -112,11 +129,12 @@ def display_map(fsa, annonce):
         "color": [0, 0, 0]  # Black for the property itself
     }])
 
-    queries = {
-        "Stationnements": f'SELECT "Latitude", "Longitude" FROM "stationnements-h-2023-2024" WHERE "FSA" = \'{fsa}\'',
-        "Bornes de recharge": f'SELECT "Latitude", "Longitude" FROM "bornes-recharge-publiques-a-jour" WHERE "FSA" = \'{fsa}\'',
-        "Arrêts de métro": f'SELECT "Latitude", "Longitude" FROM "arrets_metro" WHERE "FSA" = \'{fsa}\'',
-        "Lignes de métro": f'SELECT "Latitude", "Longitude" FROM "ligne_metro" WHERE "FSA" = \'{fsa}\''
+    # Services à moins de MAP_RADIUS_KM du logement, trouvés dans l'index spatial partagé
+    layers = {
+        "Stationnements": "stationnements",
+        "Bornes de recharge": "bornes",
+        "Arrêts de métro": "arrets_metro",
+        "Lignes de métro": "lignes_metro"
     }
 
     color_map = {
@@ -126,19 +144,19 @@ def display_map(fsa, annonce):
         "Lignes de métro": [255, 255, 0]  # Yellow
     }
     
-    counts = {key: 0 for key in queries.keys()}  # Initialize counts
+    counts = {key: 0 for key in layers.keys()}  # Initialize counts
 
     map_data = property_location.copy()
-    for location_type, query in queries.items():
+    for location_type, layer in layers.items():
         try:
-            with engine.connect() as conn:
-                result = pd.read_sql(query, conn)
-                if not result.empty:
-                    result = result.rename(columns={"Latitude": "latitude", "Longitude": "longitude"})
-                    result["type"] = location_type
-                    result["color"] = [color_map[location_type]] * len(result)
-                    map_data = pd.concat([map_data, result], ignore_index=True)
-                    counts[location_type] = len(result)  # Update counts based on the number of rows
+            index = get_spatial_index()
+            result = index.within(layer, annonce["latitude"], annonce["longitude"], MAP_RADIUS_KM)[["Latitude", "Longitude"]]
+            if not result.empty:
+                result = result.rename(columns={"Latitude": "latitude", "Longitude": "longitude"})
+                result["type"] = location_type
+                result["color"] = [color_map[location_type]] * len(result)
+                map_data = pd.concat([map_data, result], ignore_index=True)
+                counts[location_type] = len(result)  # Update counts based on the number of rows
         except Exception as e:
             st.error(f"Erreur lors de la récupération des données pour {location_type}: {e}")
 
@@ -185,91 +203,79 @@ def display_map(fsa, annonce):
 def display_supplementary_info(fsa):
     st.markdown("<h4 style='color: #4CAF50;'>📌 Informations complémentaires</h4>", unsafe_allow_html=True)
 
-    related_queries = {
-        "Stationnements": f'''
-            SELECT "ARRONDISSEMENT", "NBR_PLA", "JURIDICTION", "EMPLACEMENT", "HEURES", "NOTE_FR", "Postal Code"
-            FROM "stationnements-h-2023-2024" WHERE "FSA" = '{fsa}' LIMIT 2
-        ''',
-        "Bornes de Recharge": f'''
-            SELECT "NOM_BORNE_RECHARGE", "ADRESSE", "VILLE", "NIVEAU_RECHARGE", "MODE_TARIFICATION", "TYPE_EMPLACEMENT", "Postal Code"
-            FROM "bornes-recharge-publiques-a-jour" WHERE "FSA" = '{fsa}' LIMIT 2
-        ''',
-        "Arrêts de Métro": f'''
-            SELECT "stop_name", "Postal Code" FROM "arrets_metro" WHERE "FSA" = '{fsa}' LIMIT 2
-        ''',
-        "Lignes de Métro": f'''
-            SELECT "route_name", "headsign", "Postal Code" FROM "ligne_metro" WHERE "FSA" = '{fsa}' LIMIT 2
-        '''
-    }
+    try:
+        context = load_fsa_context(fsa)
+    except Exception as e:
+        st.error(f"Erreur lors de la récupération des données de la FSA {fsa}: {e}")
+        return
 
-    for title, query in related_queries.items():
+    for title in RELATED_QUERIES:
         try:
-            with engine.connect() as conn:
-                data = pd.read_sql(query, conn)
-                if not data.empty:
-                    st.markdown(f"<h4 style='color: #333;'>{title}</h4>", unsafe_allow_html=True)
-                    
-                    # Group results based on the relevant key
-                    if title == "Stationnements":
-                        grouped = data.groupby("ARRONDISSEMENT")
-                        for arrondissement, group in grouped:
-                            n_places = " et ".join(group["NBR_PLA"].astype(str))
-                            emplacements = " et ".join(group["EMPLACEMENT"])
-                            heures = " et ".join(group["HEURES"])
-                            notes = " et ".join(group["NOTE_FR"])
-                            st.markdown(
-                                f"""
-                                <div style="padding: 10px; border: 1px solid #ddd; border-radius: 8px; margin-bottom: 10px; background-color: #f9f9f9;">
-                                    🅿️ Dans l'arrondissement {arrondissement}, il y a {n_places} places de stationnement situées à {emplacements}.  
-                                    Les heures d'accès sont de {heures}. Note: {notes}
-                                </div>
-                                """,
-                                unsafe_allow_html=True,
-                            )
-                    
-                    elif title == "Bornes de Recharge":
-                        grouped = data.groupby("NOM_BORNE_RECHARGE")
-                        for nom_borne, group in grouped:
-                            adresses = " et ".join(group["ADRESSE"])
-                            villes = " et ".join(group["VILLE"])
-                            niveaux = " et ".join(group["NIVEAU_RECHARGE"].astype(str))
-                            tarifications = " et ".join(group["MODE_TARIFICATION"])
-                            st.markdown(
-                                f"""
-                                <div style="padding: 10px; border: 1px solid #ddd; border-radius: 8px; margin-bottom: 10px; background-color: #f9f9f9;">
-                                    🔋 Une borne de recharge appelée {nom_borne} est située à {adresses} ({villes}).  
-                                    C'est une borne de niveau {niveaux}, avec un mode de tarification {tarifications}.
-                                </div>
-                                """,
-                                unsafe_allow_html=True,
-                            )
-                    
-                    elif title == "Arrêts de Métro":
-                        grouped = data.groupby("stop_name")
-                        for stop_name, group in grouped:
-                            postcodes = " et ".join(group["Postal Code"])
-                            st.markdown(
-                                f"""
-                                <div style="padding: 10px; border: 1px solid #ddd; border-radius: 8px; margin-bottom: 10px; background-color: #f9f9f9;">
-                                    🚉 L'arrêt de métro {stop_name} se trouve à proximité de cette propriété (Codes Postaux: {postcodes}).
-                                </div>
-                                """,
-                                unsafe_allow_html=True,
-                            )
-                    
-                    elif title == "Lignes de Métro":
-                        grouped = data.groupby("route_name")
-                        for route_name, group in grouped:
-                            directions = " et ".join(group["headsign"])
-                            postcodes = " et ".join(group["Postal Code"])
-                            st.markdown(
-                                f"""
-                                <div style="padding: 10px; border: 1px solid #ddd; border-radius: 8px; margin-bottom: 10px; background-color: #f9f9f9;">
-                                    🚇 La ligne de métro {route_name} passe dans cette zone et dessert les directions {directions} (Codes Postaux: {postcodes}).
-                                </div>
-                                """,
-                                unsafe_allow_html=True,
-                            )
+            data = context[title]
+            if not data.empty:
+                st.markdown(f"<h4 style='color: #333;'>{title}</h4>", unsafe_allow_html=True)
+                
+                # Group results based on the relevant key
+                if title == "Stationnements":
+                    grouped = data.groupby("ARRONDISSEMENT")
+                    for arrondissement, group in grouped:
+                        n_places = " et ".join(group["NBR_PLA"].astype(str))
+                        emplacements = " et ".join(group["EMPLACEMENT"])
+                        heures = " et ".join(group["HEURES"])
+                        notes = " et ".join(group["NOTE_FR"])
+                        st.markdown(
+                            f"""
+                            <div style="padding: 10px; border: 1px solid #ddd; border-radius: 8px; margin-bottom: 10px; background-color: #f9f9f9;">
+                                🅿️ Dans l'arrondissement {arrondissement}, il y a {n_places} places de stationnement situées à {emplacements}.  
+                                Les heures d'accès sont de {heures}. Note: {notes}
+                            </div>
+                            """,
+                            unsafe_allow_html=True,
+                        )
+                
+                elif title == "Bornes de Recharge":
+                    grouped = data.groupby("NOM_BORNE_RECHARGE")
+                    for nom_borne, group in grouped:
+                        adresses = " et ".join(group["ADRESSE"])
+                        villes = " et ".join(group["VILLE"])
+                        niveaux = " et ".join(group["NIVEAU_RECHARGE"].astype(str))
+                        tarifications = " et ".join(group["MODE_TARIFICATION"])
+                        st.markdown(
+                            f"""
+                            <div style="padding: 10px; border: 1px solid #ddd; border-radius: 8px; margin-bottom: 10px; background-color: #f9f9f9;">
+                                🔋 Une borne de recharge appelée {nom_borne} est située à {adresses} ({villes}).  
+                                C'est une borne de niveau {niveaux}, avec un mode de tarification {tarifications}.
+                            </div>
+                            """,
+                            unsafe_allow_html=True,
+                        )
+                
+                elif title == "Arrêts de Métro":
+                    grouped = data.groupby("stop_name")
+                    for stop_name, group in grouped:
+                        postcodes = " et ".join(group["Postal Code"])
+                        st.markdown(
+                            f"""
+                            <div style="padding: 10px; border: 1px solid #ddd; border-radius: 8px; margin-bottom: 10px; background-color: #f9f9f9;">
+                                🚉 L'arrêt de métro {stop_name} se trouve à proximité de cette propriété (Codes Postaux: {postcodes}).
+                            </div>
+                            """,
+                            unsafe_allow_html=True,
+                        )
+                
+                elif title == "Lignes de Métro":
+                    grouped = data.groupby("route_name")
+                    for route_name, group in grouped:
+                        directions = " et ".join(group["headsign"])
+                        postcodes = " et ".join(group["Postal Code"])
+                        st.markdown(
+                            f"""
+                            <div style="padding: 10px; border: 1px solid #ddd; border-radius: 8px; margin-bottom: 10px; background-color: #f9f9f9;">
+                                🚇 La ligne de métro {route_name} passe dans cette zone et dessert les directions {directions} (Codes Postaux: {postcodes}).
+                            </div>
+                            """,
+                            unsafe_allow_html=True,
+                        )
 
         except Exception as e:
             st.error(f"Erreur lors de la récupération des données pour {title}: {e}")
@@ -0,0 +1,68 @@
+"""
+Index spatial partagé des couches de services: bornes de recharge, stationnements de
+déneigement, arrêts et lignes de métro. Chaque couche est chargée une seule fois par version
+des données dans un BallTree (distance haversine), qui répond aux requêtes des k plus proches
+voisins et des points dans un rayon sans parcourir toute la table.
+"""
+import numpy as np
+import pandas as pd
+import streamlit as st
+from sklearn.neighbors import BallTree
+from sqlalchemy import text
+from db import get_engine, read_sql
+
+EARTH_RADIUS_KM = 6371.0088
+
+LAYERS = {
+    "bornes": "bornes-recharge-publiques-a-jour",
+    "stationnements": "stationnements-h-2023-2024",
+    "arrets_metro": "arrets_metro",
+    "lignes_metro": "ligne_metro",
+}
+
+class SpatialIndex:
+    def __init__(self, layers: dict):
+        self.layers = {}
+        self.trees = {}
+        for name, df in layers.items():
+            df = df.dropna(subset=["Latitude", "Longitude"]).reset_index(drop=True)
+            self.layers[name] = df
+            self.trees[name] = BallTree(np.radians(df[["Latitude", "Longitude"]].to_numpy(dtype=float)), metric="haversine") if len(df) else None
+
+    def _empty(self, layer):
+        return self.layers[layer].iloc[:0].assign(distance=pd.Series(dtype=float))
+
+    def within(self, layer: str, lat: float, lon: float, radius_km: float) -> pd.DataFrame:
+        """Lignes de la couche à moins de radius_km du point, dans l'ordre de la table, avec leur distance (km)."""
+        tree = self.trees[layer]
+        if tree is None or pd.isna(lat) or pd.isna(lon):
+            return self._empty(layer)
+        indices, distances = tree.query_radius(np.radians([[lat, lon]]), r=radius_km / EARTH_RADIUS_KM, return_distance=True)
+        order = np.argsort(indices[0])
+        return self.layers[layer].iloc[indices[0][order]].assign(distance=distances[0][order] * EARTH_RADIUS_KM)
+
+    def nearest(self, layer: str, lat: float, lon: float, k: int = 1) -> pd.DataFrame:
+        """Les k lignes de la couche les plus proches du point, de la plus proche à la plus éloignée, avec leur distance (km)."""
+        tree = self.trees[layer]
+        if tree is None or pd.isna(lat) or pd.isna(lon):
+            return self._empty(layer)
+        distances, indices = tree.query(np.radians([[lat, lon]]), k=min(k, len(self.layers[layer])))
+        return self.layers[layer].iloc[indices[0]].assign(distance=distances[0] * EARTH_RADIUS_KM)
+
+# Version des données: change dès qu'une ligne d'une des couches est insérée, modifiée ou supprimée
+@st.cache_data(ttl=60)
+def data_version() -> tuple:
+    versions = read_sql("""
+        SELECT relname, n_tup_ins, n_tup_upd, n_tup_del FROM pg_stat_user_tables
+        WHERE relname = ANY(:tables) ORDER BY relname""", {"tables": list(LAYERS.values())})
+    return tuple(versions.itertuples(index=False, name=None))
+
+@st.cache_resource(max_entries=1)
+def build_spatial_index(version: tuple) -> SpatialIndex:
+    with get_engine().connect() as conn:
+        layers = {name: pd.read_sql(text(f'SELECT * FROM "{table}"'), conn) for name, table in LAYERS.items()}
+    return SpatialIndex(layers)
+
+def get_spatial_index() -> SpatialIndex:
+    """Index partagé par les pages, reconstruit seulement quand la version des données change."""
+    return build_spatial_index(data_version())
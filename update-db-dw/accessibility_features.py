@@ -0,0 +1,91 @@
+"""
+Calcule les indicateurs d'accessibilité de chaque logement dans la table logement_features
+(créée par les migrations de create-dw): distance de l'arrêt de métro le plus proche, nombre
+de bornes de recharge à 500 m et à 1 km, et nombre de places de stationnement de déneigement
+dans un rayon de SNOW_PARKING_RADIUS_KM. Le calcul se fait entièrement dans PostgreSQL, avec
+une boîte englobante indexée avant la distance haversine. L'arrêt de métro le plus proche est
+cherché dans un rayon de METRO_SEARCH_KM: au-delà, la distance reste NULL.
+
+Par défaut, seuls les logements sans indicateurs sont calculés (appelé par webscraping.py après
+l'ajout des nouvelles annonces). Utilisation en lot: python accessibility_features.py --full
+"""
+import os
+import sys
+import time
+import psycopg2
+
+POSTGRES_HOST = os.getenv('POSTGRES_HOST')
+POSTGRES_PORT = os.getenv('POSTGRES_PORT')
+POSTGRES_DB = os.getenv('POSTGRES_DB')
+POSTGRES_USER = os.getenv('POSTGRES_USER')
+POSTGRES_PASSWORD = os.getenv('POSTGRES_PASSWORD')
+SNOW_PARKING_RADIUS_KM = float(os.getenv('SNOW_PARKING_RADIUS_KM', 0.5))
+METRO_SEARCH_KM = float(os.getenv('METRO_SEARCH_KM', 5))
+
+EARTH_RADIUS_KM = 6371.0088
+KM_PER_DEGREE = 111.045
+
+def haversine_sql(lat1, lon1, lat2, lon2):
+    return (f"2 * {EARTH_RADIUS_KM} * asin(sqrt(power(sin(radians({lat2} - {lat1}) / 2), 2) + "
+            f"cos(radians({lat1})) * cos(radians({lat2})) * power(sin(radians({lon2} - {lon1}) / 2), 2)))")
+
+def bounding_box_sql(radius_km):
+    # Degrés de latitude et de longitude couvrant radius_km autour du logement l
+    dlat = radius_km / KM_PER_DEGREE
+    return (f's."Latitude" BETWEEN l.latitude - {dlat} AND l.latitude + {dlat} '
+            f'AND s."Longitude" BETWEEN l.longitude - {dlat} / cos(radians(l.latitude)) AND l.longitude + {dlat} / cos(radians(l.latitude))')
+
+def refresh_features(conn, full=False):
+    """
+    Calcule les indicateurs des logements qui n'en ont pas (ou de tous si full) et supprime ceux
+    des logements retirés de Logements. Retourne le nombre de logements calculés.
+    """
+    distance = haversine_sql("l.latitude", "l.longitude", 's."Latitude"', 's."Longitude"')
+    with conn.cursor() as cursor:
+        cursor.execute(f"""
+            INSERT INTO logement_features (url, nearest_metro_km, chargers_500m, chargers_1km, snow_parking_places, updated_at)
+            SELECT l.url, m.distance_km, b.chargers_500m, b.chargers_1km, p.places, CURRENT_TIMESTAMP
+            FROM "Logements" l
+            LEFT JOIN LATERAL (
+                SELECT {distance} AS distance_km FROM arrets_metro s
+                WHERE {bounding_box_sql(METRO_SEARCH_KM)} AND {distance} <= %(metro_radius)s
+                ORDER BY distance_km LIMIT 1
+            ) m ON TRUE
+            CROSS JOIN LATERAL (
+                SELECT count(*) FILTER (WHERE {distance} <= 0.5) AS chargers_500m,
+                       count(*) FILTER (WHERE {distance} <= 1.0) AS chargers_1km
+                FROM "bornes-recharge-publiques-a-jour" s
+                WHERE {bounding_box_sql(1.0)}
+            ) b
+            CROSS JOIN LATERAL (
+                SELECT COALESCE(sum(s."NBR_PLA"), 0) AS places
+                FROM "stationnements-h-2023-2024" s
+                WHERE {bounding_box_sql(SNOW_PARKING_RADIUS_KM)} AND {distance} <= %(radius)s
+            ) p
+            WHERE l.latitude IS NOT NULL AND l.longitude IS NOT NULL
+              AND (%(full)s OR NOT EXISTS (SELECT 1 FROM logement_features f WHERE f.url = l.url))
+            ON CONFLICT (url) DO UPDATE SET
+                nearest_metro_km = EXCLUDED.nearest_metro_km, chargers_500m = EXCLUDED.chargers_500m,
+                chargers_1km = EXCLUDED.chargers_1km, snow_parking_places = EXCLUDED.snow_parking_places,
+                updated_at = EXCLUDED.updated_at""", {'radius': SNOW_PARKING_RADIUS_KM, 'metro_radius': METRO_SEARCH_KM, 'full': full})
+        computed = cursor.rowcount
+        cursor.execute("""
+            DELETE FROM logement_features f
+            WHERE NOT EXISTS (SELECT 1 FROM "Logements" l WHERE l.url = f.url)""")
+    conn.commit()
+    return computed
+
+if __name__ == "__main__":
+    conn = psycopg2.connect(
+        host=POSTGRES_HOST,
+        port=POSTGRES_PORT,
+        dbname=POSTGRES_DB,
+        user=POSTGRES_USER,
+        password=POSTGRES_PASSWORD
+    )
+    try:
+        start = time.perf_counter()
+        computed = refresh_features(conn, full="--full" in sys.argv[1:])
+        print(f"Indicateurs d'accessibilité calculés pour {computed} logements en {time.perf_counter() - start:.2f} s.")
+    finally:
+        conn.close()
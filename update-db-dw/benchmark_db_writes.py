@@ -0,0 +1,89 @@
+"""
+Mesure le débit (lignes/s) des écritures de la mise à jour sur des annonces synthétiques:
+insertion ligne par ligne (ancienne méthode) contre insertion par COPY, puis mise à jour des
+prix et suppression des ventes. Les annonces de test sont retirées des deux bases à la fin.
+
+Utilisation: python benchmark_db_writes.py [nombre d'annonces ...]   (défaut: 10000 100000)
+"""
+import sys
+import time
+import numpy as np
+import pandas as pd
+import webscraping
+
+URL_PREFIX = "https://benchmark.invalid/"
+# FSA fictive: les médianes calculées pendant la mesure sont supprimées avec les annonces
+FSA = "Z0Z"
+
+def synthetic_listings(n: int, prefix: str) -> pd.DataFrame:
+    rng = np.random.default_rng(0)
+    return pd.DataFrame({
+        'url': [f"{URL_PREFIX}{prefix}/{i}" for i in range(n)],
+        'price': rng.integers(200000, 2000000, n),
+        'address': [f"{i} rue du Test, Montréal" for i in range(n)],
+        'bedrooms': rng.integers(1, 6, n),
+        'bathrooms': rng.integers(1, 3, n),
+        'powder_rooms': rng.integers(0, 2, n),
+        'stories': rng.integers(1, 4, n),
+        'living_area': [str(x) for x in rng.integers(500, 3000, n)],
+        'land_area': [str(x) for x in rng.integers(1000, 6000, n)],
+        'construction_year': rng.integers(1900, 2024, n),
+        'property_style': "Jumelé",
+        'floors': None,
+        'municipal_valuation': rng.integers(200000, 2000000, n),
+        'parking_spaces': rng.integers(0, 3, n),
+        'latitude': rng.uniform(45.4, 45.7, n),
+        'longitude': rng.uniform(-73.9, -73.5, n),
+        'postal_code': f"{FSA} 0A0",
+        'fsa': FSA
+    })
+
+def row_by_row_insert(conns, df):
+    columns = ', '.join(webscraping.LOGEMENT_COLUMNS)
+    placeholders = ', '.join(['%s'] * len(webscraping.LOGEMENT_COLUMNS))
+    rows = [tuple(webscraping.copy_value(c, row.get(c)) for c in webscraping.LOGEMENT_COLUMNS) for row in df.to_dict('records')]
+    with conns[0].cursor() as cursor:
+        for row in rows:
+            cursor.execute(f'INSERT INTO "Logements" ({columns}) VALUES ({placeholders}) ON CONFLICT (url) DO NOTHING', row)
+    conns[0].commit()
+    with conns[1].cursor() as cursor:
+        for row in rows:
+            cursor.execute(f'INSERT INTO "dw_dim_logements" ({columns}) VALUES ({placeholders})', row)
+    conns[1].commit()
+
+def cleanup(conns):
+    with conns[0].cursor() as cursor:
+        cursor.execute('DELETE FROM "Logements" WHERE url LIKE %s', (URL_PREFIX + '%',))
+    conns[0].commit()
+    with conns[1].cursor() as cursor:
+        cursor.execute('DELETE FROM fact_price_events WHERE url LIKE %s', (URL_PREFIX + '%',))
+        cursor.execute('DELETE FROM agg_price_fsa_daily WHERE fsa = %s', (FSA,))
+        cursor.execute('DELETE FROM agg_price_fsa_weekly WHERE fsa = %s', (FSA,))
+        cursor.execute('DELETE FROM "dw_dim_logements" WHERE url LIKE %s', (URL_PREFIX + '%',))
+    conns[1].commit()
+
+def report(label, n, function, *args):
+    start = time.perf_counter()
+    function(*args)
+    elapsed = time.perf_counter() - start
+    print(f"  {label:<28} {elapsed:8.2f} s  {n / elapsed:10.0f} lignes/s")
+
+if __name__ == "__main__":
+    sizes = [int(n) for n in sys.argv[1:]] or [10000, 100000]
+    conns = webscraping.connect_to_postgres()
+    try:
+        for n in sizes:
+            print(f"{n} annonces")
+            report("insertion ligne par ligne", n, row_by_row_insert, conns, synthetic_listings(n, f"rows-{n}"))
+
+            listings = synthetic_listings(n, f"copy-{n}")
+            report("insertion par COPY", n, webscraping.db_dw_add_new_info, conns, listings.copy())
+
+            changes = listings[['url', 'price']].assign(price=listings['price'] + 1000, action='price_change')
+            report("changements de prix", n, webscraping.db_update_price, conns, changes)
+            report("ventes", n, webscraping.db_remove_sold_info, conns, changes.assign(price=np.nan, action='sold'))
+            cleanup(conns)
+    finally:
+        cleanup(conns)
+        conns[0].close()
+        conns[1].close()
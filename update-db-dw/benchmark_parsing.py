@@ -0,0 +1,49 @@
+"""
+Compare le temps d'analyse des pages d'annonces sauvegardées entre l'ancien parseur
+(html5lib, page complète) et le nouveau (lxml, sous-arbre de l'annonce seulement),
+puis avec le pool de processus, et vérifie que tous donnent les mêmes lignes.
+
+Utilisation: python benchmark_parsing.py <dossier de pages .html> duproprio|royallepage
+"""
+import glob
+import os
+import sys
+import time
+import webscraping
+
+SOURCES = {
+    'duproprio': webscraping.duproprio_listing_row,
+    'royallepage': webscraping.royallepage_listing_row
+}
+
+def parse_serial(parser, parse_row, pages):
+    # html5lib ne supporte pas parse_only: il construit toujours la page complète
+    webscraping.HTML_PARSER = parser
+    return [parse_row(page) for page in pages]
+
+def parse_pool(parser, parse_row, pages):
+    webscraping.HTML_PARSER = parser
+    return webscraping.parse_all(parse_row, pages)
+
+def timed(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - start
+
+if __name__ == "__main__":
+    directory, source = sys.argv[1], sys.argv[2]
+    parse_row = SOURCES[source]
+
+    pages = []
+    for path in sorted(glob.glob(os.path.join(directory, "*.html"))):
+        with open(path, encoding="utf-8") as f:
+            pages.append([os.path.basename(path), f.read()])
+
+    print(f"{len(pages)} pages")
+    reference, reference_time = timed(parse_serial, "html5lib", parse_row, pages)
+    print(f"html5lib:             {reference_time:.2f} s ({len(pages) / reference_time:.1f} pages/s)")
+
+    for label, function in [("lxml", parse_serial), (f"lxml, {webscraping.PARSE_WORKERS} processus", parse_pool)]:
+        rows, elapsed = timed(function, "lxml", parse_row, pages)
+        status = "identique" if rows == reference else "différent!"
+        print(f"{label + ':':<21} {elapsed:.2f} s ({len(pages) / elapsed:.1f} pages/s, x{reference_time / elapsed:.1f}, {status})")
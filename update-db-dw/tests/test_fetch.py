@@ -0,0 +1,71 @@
+import os
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import webscraping
+
+# Pages enregistrées servies par le serveur local: chemin -> (délai en secondes, contenu)
+PAGES = {f"/annonce/{i}": (0.05 * (4 - i), f"<html>annonce {i}</html>") for i in range(5)}
+
+class RecordedPages(BaseHTTPRequestHandler):
+    hits = {}
+    lock = threading.Lock()
+
+    def do_GET(self):
+        with self.lock:
+            self.hits[self.path] = self.hits.get(self.path, 0) + 1
+            hits = self.hits[self.path]
+        if (self.path == "/instable" and hits == 1) or self.path == "/indisponible":
+            self.respond(503, "indisponible")
+        elif self.path == "/instable":
+            self.respond(200, "<html>instable</html>")
+        elif self.path in PAGES:
+            delay, page = PAGES[self.path]
+            time.sleep(delay)
+            self.respond(200, page)
+        else:
+            self.respond(404, "introuvable")
+
+    def respond(self, status, body):
+        body = body.encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "text/html; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+@pytest.fixture
+def server(monkeypatch):
+    monkeypatch.setattr(webscraping, "ARCHIVE_DIR", "")
+    monkeypatch.setattr(webscraping, "FETCH_BACKOFF", 0)
+    monkeypatch.setattr(webscraping, "FETCH_RETRIES", 2)
+    RecordedPages.hits = {}
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), RecordedPages)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{httpd.server_address[1]}"
+    httpd.shutdown()
+    httpd.server_close()
+
+def test_fetch_all_keeps_input_order(server):
+    # Les premières pages sont les plus lentes: elles arrivent en dernier
+    pages = webscraping.fetch_all([server + path for path in PAGES])
+    assert pages == [page for _, page in PAGES.values()]
+
+def test_fetch_response_retries_503(server):
+    response = webscraping.fetch_response(server + "/instable")
+    assert response is not None and response.status_code == 200
+    assert response.text == "<html>instable</html>"
+    assert RecordedPages.hits["/instable"] == 2
+
+def test_fetch_response_gives_up_after_retries(server):
+    assert webscraping.fetch_response(server + "/indisponible") is None
+    assert RecordedPages.hits["/indisponible"] == 3
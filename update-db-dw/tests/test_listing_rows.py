@@ -0,0 +1,52 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import webscraping
+
+DUPROPRIO_PAGE = """
+<html><body>
+<article class="listing-tab-content__content is-active">
+  <div class="listing-main-characteristics__label">3 chambres</div>
+  <div class="listing-main-characteristics__label">1 salle de bain</div>
+  <div class="listing-box__dotted-row">
+    <div>Année de construction</div>
+    <div>1925</div>
+  </div>
+</article>
+</body></html>
+"""
+
+ROYALLEPAGE_PAGE = """
+<html><body>
+<div class="rlp property-wrapper feed-3 js-property">
+  <div class="expandable-box__hidden js-expandable-box-target">
+    <ul>
+      <li>Chambres:
+        2</li>
+      <li>Bâti en:
+        1950</li>
+    </ul>
+  </div>
+</div>
+</body></html>
+"""
+
+def test_duproprio_listing_with_extra_classes():
+    row = webscraping.duproprio_listing_row(["https://duproprio.com/fr/1", DUPROPRIO_PAGE])
+    assert row is not None
+    assert row[0] == "https://duproprio.com/fr/1"
+    assert row[1] == 3 and row[2] == 1
+    assert row[7] == 1925
+
+def test_royallepage_listing_with_reordered_classes():
+    row = webscraping.royallepage_listing_row(["https://www.royallepage.ca/fr/1", ROYALLEPAGE_PAGE])
+    assert row is not None
+    assert row[0] == "https://www.royallepage.ca/fr/1"
+    assert row[1] == 2
+    assert row[7] == 1950
+
+def test_listing_without_container():
+    assert webscraping.duproprio_listing_row(["u", "<article class='other'></article>"]) is None
+    assert webscraping.royallepage_listing_row(["u", "<div class='property-wrapper'></div>"]) is None
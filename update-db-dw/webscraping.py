@@ -2,12 +2,59 @@ import pandas as pd
 import numpy as np
 import requests
 import re
-from bs4 import BeautifulSoup
+from bs4 import BeautifulSoup, SoupStrainer
 from datetime import datetime
 from unidecode import unidecode
-from urllib.parse import quote
+from urllib.parse import quote, urlparse
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import threading
+import multiprocessing
+import time
+import sqlite3
+import hashlib
+import json
+import gzip
+import sys
+from collections import namedtuple
+from queue import Queue
+import csv
+import io
+from functools import lru_cache
 import psycopg2
 import os
+from accessibility_features import refresh_features
+
+FETCH_WORKERS = int(os.getenv('FETCH_WORKERS', 16))
+FETCH_PER_HOST = int(os.getenv('FETCH_PER_HOST', 4))
+FETCH_RETRIES = int(os.getenv('FETCH_RETRIES', 3))
+FETCH_BACKOFF = float(os.getenv('FETCH_BACKOFF', 1.0))
+FETCH_TIMEOUT = float(os.getenv('FETCH_TIMEOUT', 30))
+
+GEOCODE_CACHE = os.getenv('GEOCODE_CACHE', '/update-db-dw/cache/geocode.sqlite')
+GEOCODE_TTL_DAYS = float(os.getenv('GEOCODE_TTL_DAYS', 180))
+GEOCODE_NEGATIVE_TTL_DAYS = float(os.getenv('GEOCODE_NEGATIVE_TTL_DAYS', 7))
+OSM_MIN_INTERVAL = float(os.getenv('OSM_MIN_INTERVAL', 1.0))
+OSM_TIMEOUT = float(os.getenv('OSM_TIMEOUT', 10))
+
+CRAWL_STATE = os.getenv('CRAWL_STATE', '/update-db-dw/cache/crawl_state.sqlite')
+
+ARCHIVE_DIR = os.getenv('ARCHIVE_DIR', '/update-db-dw/cache/archive')
+REPLAY_OUTPUT = os.getenv('REPLAY_OUTPUT', '/update-db-dw/cache/replay')
+RUN_ID = datetime.now().strftime("%Y%m%dT%H%M%S")
+REPLAY_RUN = None
+
+CHANGE_DETECTION = os.getenv('CHANGE_DETECTION', 'sql')
+
+UPDATE_BATCH_SIZE = int(os.getenv('UPDATE_BATCH_SIZE', 100))
+UPDATE_PREFETCH = int(os.getenv('UPDATE_PREFETCH', 1))
+
+HTML_PARSER = os.getenv('HTML_PARSER', 'lxml')
+PARSE_WORKERS = int(os.getenv('PARSE_WORKERS', os.cpu_count() or 1))
+PARSE_START_METHOD = os.getenv('PARSE_START_METHOD', 'forkserver')
+
+GEOCODER = os.getenv('GEOCODER', 'osm')
+GEOCODER_ADDRESSES = os.getenv('GEOCODER_ADDRESSES', '/update-db-dw/geodata/adresses.csv')
+GEOCODER_POSTAL_CODES = os.getenv('GEOCODER_POSTAL_CODES', '/update-db-dw/geodata/codes_postaux.csv')
 
 ## General functions
 
@@ -26,17 +73,38 @@ def define_summary_changes(listings: list, old_listings: pd.DataFrame) -> pd.Dat
     
     return df[df['url'].str.contains('duproprio')], df[~df['url'].str.contains('duproprio')]
 
+_osm_lock = threading.Lock()
+_osm_last_request = 0.0
+
+def osm_throttle():
+    """
+    Nominatim limite l'usage à une requête par seconde: on attend le temps nécessaire depuis la dernière requête.
+    """
+    global _osm_last_request
+    with _osm_lock:
+        wait = _osm_last_request + OSM_MIN_INTERVAL - time.monotonic()
+        if wait > 0:
+            time.sleep(wait)
+        _osm_last_request = time.monotonic()
+
 def coordinates_osm(address):
     """
     Cette fonction prend une adresse, l'encode pour l'URL, envoie une requête à l'API OpenStreetMap
     et récupère les coordonnées géographiques (latitude, longitude), le code postal et le FSA.
+    Retourne None (et non un tuple vide) si la requête elle-même a échoué (erreur HTTP, délai de
+    OSM_TIMEOUT dépassé, connexion coupée), pour ne pas mettre l'échec en cache.
     """
     encoded_address = quote(address)
     url = f"https://nominatim.openstreetmap.org/search?q={encoded_address}&format=json&addressdetails=1&limit=1"
-    response = requests.get(url, headers={'User-Agent': 'Mozilla/5.0 (compatible; OpenAI-Request;)'})
+    osm_throttle()
+    try:
+        response = requests.get(url, headers={'User-Agent': 'Mozilla/5.0 (compatible; OpenAI-Request;)'}, timeout=OSM_TIMEOUT)
+        data = response.json() if response.status_code == 200 else None
+    except (requests.RequestException, ValueError) as e:
+        print(f"Erreur lors de la requête pour l'adresse {address}: {e}")
+        return None
 
     if response.status_code == 200:
-        data = response.json()
         if data:
             latitude = data[0]["lat"]
             longitude = data[0]["lon"]
@@ -51,213 +119,623 @@ def coordinates_osm(address):
             return None, None, None, None
     else:
         print(f"Erreur lors de la requête pour l'adresse {address}: {response.status_code}")
-        return None, None, None, None
+        return None
+
+def normalize_address(address):
+    if not isinstance(address, str):
+        return None
+    return re.sub("\\s+", " ", re.sub("[^a-z0-9]", " ", unidecode(address).lower())).strip() or None
+
+def geocode_cache_connect(path: str = GEOCODE_CACHE) -> sqlite3.Connection:
+    if os.path.dirname(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    conn = sqlite3.connect(path)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS geocodes (
+            address TEXT PRIMARY KEY,
+            latitude TEXT,
+            longitude TEXT,
+            postal_code TEXT,
+            fsa TEXT,
+            fetched_at REAL)""")
+    return conn
+
+def geocode_addresses(addresses) -> dict:
+    """
+    Géocode un lot d'adresses en passant par le cache SQLite: chaque adresse normalisée n'est
+    demandée qu'une fois, et seules celles absentes ou expirées du cache interrogent Nominatim.
+    Les adresses introuvables sont aussi mises en cache, avec une durée de vie plus courte.
+    Retourne un dictionnaire {adresse normalisée: (latitude, longitude, postal_code, fsa)}.
+    """
+    pending = {}
+    for address in addresses:
+        key = normalize_address(address)
+        if key is not None and key not in pending:
+            pending[key] = address
+
+    geocodes = {}
+    conn = geocode_cache_connect()
+    now = time.time()
+    try:
+        for key, address in pending.items():
+            row = conn.execute("SELECT latitude, longitude, postal_code, fsa, fetched_at FROM geocodes WHERE address = ?", (key,)).fetchone()
+            if row:
+                ttl = GEOCODE_TTL_DAYS if row[0] is not None else GEOCODE_NEGATIVE_TTL_DAYS
+                if now - row[4] < ttl * 86400:
+                    geocodes[key] = row[:4]
+                    continue
+
+            result = coordinates_osm(address)
+            if result is None:
+                geocodes[key] = (None, None, None, None)
+                continue
+
+            geocodes[key] = result
+            conn.execute("INSERT OR REPLACE INTO geocodes VALUES (?, ?, ?, ?, ?, ?)", (key, *result, time.time()))
+            conn.commit()
+    finally:
+        conn.close()
+
+    return geocodes
+
+def format_postal_code(postal_code):
+    if not isinstance(postal_code, str):
+        return None
+    postal_code = re.sub("\\s", "", postal_code.upper())
+    return f"{postal_code[:3]} {postal_code[3:]}" if len(postal_code) == 6 else None
+
+@lru_cache(maxsize=1)
+def offline_index() -> tuple:
+    """
+    Charge une fois les fichiers de référence locaux et construit deux index en mémoire:
+    adresse normalisée -> géocode (points d'adresse) et code postal -> centroïde.
+    Fichiers CSV attendus: GEOCODER_ADDRESSES (address, latitude, longitude, postal_code)
+    et GEOCODER_POSTAL_CODES (postal_code, latitude, longitude). Un fichier absent donne un index vide.
+    """
+    addresses, postal_codes = {}, {}
+
+    if os.path.isfile(GEOCODER_ADDRESSES):
+        points = pd.read_csv(GEOCODER_ADDRESSES, dtype=str)
+        for address, latitude, longitude, postal_code in points[['address', 'latitude', 'longitude', 'postal_code']].itertuples(index=False):
+            key = normalize_address(address)
+            postal_code = format_postal_code(postal_code)
+            if key is not None:
+                addresses[key] = (latitude, longitude, postal_code, postal_code[:3] if postal_code else None)
+
+    if os.path.isfile(GEOCODER_POSTAL_CODES):
+        centroids = pd.read_csv(GEOCODER_POSTAL_CODES, dtype=str)
+        for postal_code, latitude, longitude in centroids[['postal_code', 'latitude', 'longitude']].itertuples(index=False):
+            postal_code = format_postal_code(postal_code)
+            if postal_code is not None:
+                postal_codes[postal_code] = (latitude, longitude, postal_code, postal_code[:3])
+
+    print(f"Index de géocodage local chargé: {len(addresses)} adresses, {len(postal_codes)} codes postaux.")
+    return addresses, postal_codes
+
+def geocode_addresses_offline(addresses) -> dict:
+    """
+    Résout les adresses avec l'index local: d'abord l'adresse exacte, puis le centroïde du code
+    postal s'il apparaît dans l'adresse. Seules les adresses introuvables localement passent par
+    Nominatim (et son cache). Même format de retour que geocode_addresses.
+    """
+    address_index, postal_code_index = offline_index()
+    geocodes, misses = {}, []
+
+    for address in addresses:
+        key = normalize_address(address)
+        if key is None or key in geocodes:
+            continue
+        if key in address_index:
+            geocodes[key] = address_index[key]
+            continue
+        postal_code = re.search("[A-Z][0-9][A-Z] ?[0-9][A-Z][0-9]", address.upper())
+        postal_code = format_postal_code(postal_code.group(0)) if postal_code else None
+        if postal_code in postal_code_index:
+            geocodes[key] = postal_code_index[postal_code]
+        else:
+            misses.append(address)
+
+    geocodes.update(geocode_addresses(misses))
+    return geocodes
+
+GEOCODERS = {
+    'osm': geocode_addresses,
+    'offline': geocode_addresses_offline
+}
 
 def enhance(df):
-    geocodes = df['address'].apply(lambda address: pd.Series(coordinates_osm(address)))
-    if geocodes.shape[0] == 0:
+    geocodes = GEOCODERS[GEOCODER](df['address'])
+    if df.shape[0] == 0:
         df[['latitude', 'longitude', 'postal_code', 'fsa']] = None, None, None, None
     else:
-        df[['latitude', 'longitude', 'postal_code', 'fsa']] = geocodes
+        df[['latitude', 'longitude', 'postal_code', 'fsa']] = pd.DataFrame(
+            [geocodes.get(normalize_address(address), (None, None, None, None)) for address in df['address']],
+            index=df.index
+        )
     return df
 
+## Page archive
+
+ArchivedResponse = namedtuple('ArchivedResponse', ['status_code', 'text', 'headers'])
+
+_archive = None
+_archive_lock = threading.Lock()
+
+def archive_connect() -> sqlite3.Connection:
+    """
+    Index de l'archive: chaque page distincte (adressée par le SHA-256 de son contenu) est stockée
+    une seule fois, compressée, dans le segment du run qui l'a vue en premier; fetches garde la
+    trace de chaque URL téléchargée à chaque run.
+    """
+    global _archive
+    if _archive is None:
+        os.makedirs(ARCHIVE_DIR, exist_ok=True)
+        _archive = sqlite3.connect(os.path.join(ARCHIVE_DIR, 'index.sqlite'), check_same_thread=False)
+        _archive.execute("""
+            CREATE TABLE IF NOT EXISTS pages (
+                hash TEXT PRIMARY KEY,
+                segment TEXT,
+                offset INTEGER,
+                length INTEGER)""")
+        _archive.execute("""
+            CREATE TABLE IF NOT EXISTS fetches (
+                url TEXT,
+                hash TEXT,
+                run TEXT,
+                PRIMARY KEY (url, run))""")
+    return _archive
+
+def archive_page(url, page=None, content_hash=None):
+    """
+    Ajoute une page à l'archive (segment gzip du run courant) et enregistre son téléchargement.
+    Sans page, seul le téléchargement d'un contenu déjà archivé est enregistré (réponse 304).
+    """
+    if not ARCHIVE_DIR:
+        return
+    if content_hash is None:
+        content_hash = hashlib.sha256(page.encode()).hexdigest()
+
+    with _archive_lock:
+        conn = archive_connect()
+        if not conn.execute("SELECT 1 FROM pages WHERE hash = ?", (content_hash,)).fetchone():
+            if page is None:
+                return
+            data = gzip.compress(page.encode())
+            segment = f"segment-{RUN_ID}.gz"
+            with open(os.path.join(ARCHIVE_DIR, segment), 'ab') as f:
+                offset = f.tell()
+                f.write(data)
+            conn.execute("INSERT INTO pages VALUES (?, ?, ?, ?)", (content_hash, segment, offset, len(data)))
+        conn.execute("INSERT OR REPLACE INTO fetches VALUES (?, ?, ?)", (url, content_hash, RUN_ID))
+        conn.commit()
+
+def archived_page(url, run=None):
+    """
+    Retourne la dernière version archivée de l'URL téléchargée au plus tard lors du run donné.
+    """
+    with _archive_lock:
+        row = archive_connect().execute("""
+            SELECT p.segment, p.offset, p.length FROM fetches f JOIN pages p ON p.hash = f.hash
+            WHERE f.url = ? AND f.run <= ? ORDER BY f.run DESC LIMIT 1""", (url, run or RUN_ID)).fetchone()
+    if row is None:
+        return None
+    with open(os.path.join(ARCHIVE_DIR, row[0]), 'rb') as f:
+        f.seek(row[1])
+        return gzip.decompress(f.read(row[2])).decode()
+
+## Fetch functions
+
+_host_limits = {}
+_host_limits_lock = threading.Lock()
+_sessions = threading.local()
+
+def host_limit(url):
+    """
+    Retourne le sémaphore qui borne le nombre de requêtes simultanées vers l'hôte de l'URL.
+    """
+    host = urlparse(url).netloc
+    with _host_limits_lock:
+        if host not in _host_limits:
+            _host_limits[host] = threading.BoundedSemaphore(FETCH_PER_HOST)
+        return _host_limits[host]
+
+def thread_session() -> requests.Session:
+    """
+    Chaque thread garde sa propre session pour réutiliser ses connexions sans les partager.
+    """
+    if not hasattr(_sessions, 'session'):
+        _sessions.session = requests.Session()
+    return _sessions.session
+
+def fetch_response(url, headers=None):
+    """
+    Télécharge une page en respectant la limite par hôte. Les erreurs réseau, les codes 429 et 5xx
+    sont réessayés avec un backoff exponentiel; retourne None si toutes les tentatives échouent.
+    En mode replay, la page est lue dans l'archive au lieu d'être téléchargée.
+    """
+    if REPLAY_RUN is not None:
+        page = archived_page(url, REPLAY_RUN)
+        return ArchivedResponse(200, page, {}) if page is not None else None
+
+    for attempt in range(FETCH_RETRIES + 1):
+        try:
+            with host_limit(url):
+                response = thread_session().get(url, headers=headers, timeout=FETCH_TIMEOUT)
+            if response.status_code != 429 and response.status_code < 500:
+                if response.status_code == 200:
+                    archive_page(url, response.text)
+                return response
+            error = response.status_code
+        except requests.RequestException as e:
+            error = e
+        if attempt < FETCH_RETRIES:
+            time.sleep(FETCH_BACKOFF * 2 ** attempt)
+    print(f"Erreur lors de la requête pour l'URL {url}: {error}")
+    return None
+
+def fetch(url):
+    response = fetch_response(url)
+    return response.text if response is not None else None
+
+def fetch_all(urls) -> list:
+    """
+    Télécharge toutes les URLs en parallèle et retourne les pages dans le même ordre que les URLs.
+    """
+    with ThreadPoolExecutor(max_workers=FETCH_WORKERS) as executor:
+        return list(executor.map(fetch, urls))
+
+def fetch_all_responses(urls, headers) -> list:
+    with ThreadPoolExecutor(max_workers=FETCH_WORKERS) as executor:
+        return list(executor.map(fetch_response, urls, headers))
+
+def parse_html(page, parse_only=None) -> BeautifulSoup:
+    """
+    Analyse une page avec le parseur configuré (lxml par défaut, beaucoup plus rapide que html5lib).
+    Avec parse_only, seul le sous-arbre utile de la page est construit.
+    """
+    return BeautifulSoup(page or "", HTML_PARSER, parse_only=parse_only)
+
+_parse_pool = None
+_parse_pool_lock = threading.Lock()
+
+def parse_pool() -> ProcessPoolExecutor:
+    """
+    Pool de processus de parsing, créé au premier appel et réutilisé par tous les lots. Les
+    processus sont démarrés par un serveur (forkserver) et non par fork du processus courant,
+    dont les threads de téléchargement peuvent détenir des verrous au moment du fork.
+    """
+    global _parse_pool
+    with _parse_pool_lock:
+        if _parse_pool is None:
+            _parse_pool = ProcessPoolExecutor(max_workers=PARSE_WORKERS, mp_context=multiprocessing.get_context(PARSE_START_METHOD))
+        return _parse_pool
+
+def parse_all(parse_row, raw_listings: list, pool: ProcessPoolExecutor = None) -> list:
+    """
+    Applique la fonction de parsing à chaque page brute dans un pool de processus (par défaut
+    celui de parse_pool), pour que l'analyse HTML utilise tous les coeurs sans bloquer le GIL
+    des téléchargements.
+    """
+    if PARSE_WORKERS <= 1 or len(raw_listings) < 2:
+        return [parse_row(listing) for listing in raw_listings]
+    pool = pool or parse_pool()
+    return list(pool.map(parse_row, raw_listings, chunksize=max(1, len(raw_listings) // (4 * PARSE_WORKERS))))
+
+## Crawl state
+
+def crawl_state_connect(path: str = CRAWL_STATE) -> sqlite3.Connection:
+    if os.path.dirname(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    conn = sqlite3.connect(path)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS crawl_state (
+            url TEXT PRIMARY KEY,
+            etag TEXT,
+            last_modified TEXT,
+            content_hash TEXT,
+            result TEXT,
+            fetched_at REAL)""")
+    return conn
+
+def conditional_headers(state) -> dict:
+    headers = {}
+    if state and state[3] is not None:
+        if state[0]: headers['If-None-Match'] = state[0]
+        if state[1]: headers['If-Modified-Since'] = state[1]
+    return headers
+
+def crawl_pages(conn, urls: list, find_listings, find_count, summary_row) -> list:
+    """
+    Télécharge des pages de résultats avec des requêtes conditionnelles (ETag / Last-Modified).
+    Pour une page non modifiée (304, ou contenu au même hash qu'au dernier passage), l'analyse est
+    sautée et les lignes extraites la dernière fois sont réutilisées. Retourne pour chaque URL un
+    couple (nombre total d'annonces, annonces), les annonces étant des éléments HTML pour les pages
+    analysées et des lignes déjà extraites pour les pages inchangées.
+    Une page qui reste indisponible après les tentatives lève une erreur: un résultat partiel
+    ferait passer ses annonces pour vendues lors de la détection des changements.
+    """
+    if REPLAY_RUN is not None:
+        states = {url: None for url in urls}
+    else:
+        states = {url: conn.execute("SELECT etag, last_modified, content_hash, result FROM crawl_state WHERE url = ?", (url,)).fetchone() for url in urls}
+    responses = fetch_all_responses(urls, [conditional_headers(states[url]) for url in urls])
+
+    results = []
+    for url, response in zip(urls, responses):
+        state = states[url]
+        if response is not None and response.status_code == 304 and state and state[3] is not None:
+            archive_page(url, content_hash=state[2])
+            results.append(json.loads(state[3]))
+            continue
+
+        if response is None or response.status_code != 200:
+            status = response.status_code if response is not None else "aucune réponse"
+            raise RuntimeError(f"Page de résultats indisponible: {url} ({status})")
+
+        page = response.text
+        content_hash = hashlib.sha256(page.encode()).hexdigest() if page else None
+        etag = response.headers.get('ETag')
+        last_modified = response.headers.get('Last-Modified')
+
+        if content_hash is not None and state and state[2] == content_hash and state[3] is not None:
+            conn.execute("UPDATE crawl_state SET etag = ?, last_modified = ?, fetched_at = ? WHERE url = ?", (etag, last_modified, time.time(), url))
+            results.append(json.loads(state[3]))
+            continue
+
+        soup = parse_html(page)
+        listings = find_listings(soup)
+        try: count = find_count(soup)
+        except: count = None
+
+        if count is not None and REPLAY_RUN is None:
+            result = json.dumps([count, [summary_row(listing) for listing in listings]])
+            conn.execute("INSERT OR REPLACE INTO crawl_state VALUES (?, ?, ?, ?, ?, ?)", (url, etag, last_modified, content_hash, result, time.time()))
+        results.append([count, listings])
+
+    conn.commit()
+    return results
+
+def paginate(page_url, find_listings, find_count, summary_row) -> list:
+    """
+    La première page donne le nombre total d'annonces et la taille d'une page; les pages suivantes
+    sont alors téléchargées en parallèle. Les annonces vues sur deux pages (parce qu'elles se sont
+    déplacées pendant la collecte) ne sont gardées qu'une fois.
+    """
+    conn = crawl_state_connect()
+    try:
+        nb, raw_listings = crawl_pages(conn, [page_url(1)], find_listings, find_count, summary_row)[0]
+        if nb is None:
+            raise ValueError(f"Nombre d'annonces introuvable sur la page {page_url(1)}")
+
+        if raw_listings:
+            nb_pages = -(-nb // len(raw_listings))
+            for _, listings in crawl_pages(conn, [page_url(i) for i in range(2, nb_pages + 1)], find_listings, find_count, summary_row):
+                raw_listings.extend(listings)
+    finally:
+        conn.close()
+
+    unique_listings, seen = [], set()
+    for listing in raw_listings:
+        key = (listing if isinstance(listing, list) else summary_row(listing))[0]
+        if key is not None and key in seen: continue
+        seen.add(key)
+        unique_listings.append(listing)
+
+    return unique_listings
+
+def has_classes(*names):
+    """
+    Filtre de classe pour find() et SoupStrainer: l'élément doit porter toutes ces classes, dans
+    n'importe quel ordre et parmi d'autres. {"class": "..."} dans un SoupStrainer compare au
+    contraire la valeur complète de l'attribut.
+    """
+    def match(value):
+        return value is not None and set(names) <= set(value.split() if isinstance(value, str) else value)
+    return match
+
 ## DuProprio functions
 
-def duproprio_summary_raw() -> list:
-    raw_listings = []
-    nb = float("inf")
-    i = 1
+DUPROPRIO_CLASSES = has_classes("listing-tab-content__content")
+DUPROPRIO_LISTING = SoupStrainer("article", class_=DUPROPRIO_CLASSES)
 
-    session = requests.Session()
+def duproprio_page_url(i: int) -> str:
+    return f"https://duproprio.com/fr/rechercher/liste?search=true&cities%5B0%5D=1889&pageNumber={i}"
 
-    while len(raw_listings) < nb:
-        url = f"https://duproprio.com/fr/rechercher/liste?search=true&cities%5B0%5D=1889&pageNumber={i}"
-        soup = BeautifulSoup(session.get(url).text, "html5lib")
-        raw_listings.extend(soup.find_all("div", {"class": "search-results-listings-list__container"}))
-        nb = int(soup.find("span", {"class": "search-results-listings-header__properties-found__number"}).text.strip())
-        i += 1
+def duproprio_summary_raw() -> list:
+    return paginate(
+        duproprio_page_url,
+        lambda soup: soup.find_all("div", {"class": "search-results-listings-list__container"}),
+        lambda soup: int(soup.find("span", {"class": "search-results-listings-header__properties-found__number"}).text.strip()),
+        duproprio_summary_row
+    )
 
-    return raw_listings
+def duproprio_summary_row(listing) -> list:
+    try: url = listing.find("a", {"class": "search-results-listings-list__item-bottom-container"}).get("href")
+    except: url = None
 
-def duproprio_summary_info(raw_html: list) -> pd.DataFrame:
-    res = []
-    for listing in raw_html:
-        try: url = listing.find("a", {"class": "search-results-listings-list__item-bottom-container"}).get("href")
-        except: url = None
+    try: price = int(re.sub("\\s|\\$", "", listing.find("div", {"class": "search-results-listings-list__item-description__price"}).text))
+    except: price = None
 
-        try: price = int(re.sub("\\s|\\$", "", listing.find("div", {"class": "search-results-listings-list__item-description__price"}).text))
-        except: price = None
+    try: address = listing.find("div", {"class": "search-results-listings-list__item-description__address"}).text.strip()
+    except: address = None
 
-        try: address = listing.find("div", {"class": "search-results-listings-list__item-description__address"}).text.strip()
-        except: address = None
+    return [url, price, address]
 
-        res.append([url, price, address])
+def duproprio_summary_info(raw_html: list) -> pd.DataFrame:
+    # Les annonces des pages inchangées arrivent déjà sous forme de lignes
+    res = [listing if isinstance(listing, list) else duproprio_summary_row(listing) for listing in raw_html]
     return pd.DataFrame(res, columns=['url', 'price', 'address'])
 
 def duproprio_individual_raw(urls: pd.Series) -> list:
-    raw_listings = []
-    session = requests.Session()
-    for url in urls:
-        soup = BeautifulSoup(session.get(url).text, "html5lib")
-        raw_listings.append([url, soup.find("article", {"class": "listing-tab-content__content"})])
-    return raw_listings
+    urls = list(urls)
+    return [[url, page] for url, page in zip(urls, fetch_all(urls))]
 
-def duproprio_individual_info(raw_listing_html: list, listings: pd.DataFrame) -> pd.DataFrame:
-    res = []
-    for listing in raw_listing_html:
-        main_specs = listing[1].find_all("div", {"class": "listing-main-characteristics__label"})
-        main_specs = dict(re.sub("\\s+", " ", re.sub("\\n", "", x.text).strip()).split(" ", 1)[::-1] for x in main_specs)
+def duproprio_listing_row(listing: list):
+    """
+    Analyse la page HTML brute d'une annonce et retourne la ligne de caractéristiques, ou None.
+    Fonction de niveau module pour pouvoir être exécutée dans un processus de parsing.
+    """
+    content = parse_html(listing[1], DUPROPRIO_LISTING).find("article", class_=DUPROPRIO_CLASSES)
+    if content is None: return None
 
-        try: bedrooms = [int(main_specs[key]) for key in ["chambre", "chambres"] if key in main_specs][0]
-        except: bedrooms = None
+    main_specs = content.find_all("div", {"class": "listing-main-characteristics__label"})
+    main_specs = dict(re.sub("\\s+", " ", re.sub("\\n", "", x.text).strip()).split(" ", 1)[::-1] for x in main_specs)
 
-        try: bathrooms = [int(main_specs[key]) for key in ["salle de bain", "salles de bain"] if key in main_specs][0]
-        except: bathrooms = None
+    try: bedrooms = [int(main_specs[key]) for key in ["chambre", "chambres"] if key in main_specs][0]
+    except: bedrooms = None
 
-        try: powder_rooms = [int(main_specs[key]) for key in ["salle d’eau", "salles d’eau"] if key in main_specs][0]
-        except: powder_rooms = None
+    try: bathrooms = [int(main_specs[key]) for key in ["salle de bain", "salles de bain"] if key in main_specs][0]
+    except: bathrooms = None
 
-        try: stories = [int(main_specs[key]) for key in ["étage", "étages"] if key in main_specs][0]
-        except: stories = None
+    try: powder_rooms = [int(main_specs[key]) for key in ["salle d’eau", "salles d’eau"] if key in main_specs][0]
+    except: powder_rooms = None
 
-        try:
-            living_area = listing[1].find("div", {"class": "listing-main-characteristics__item listing-main-characteristics__item--living-space-area"})
-            living_area = living_area.find("span", {"class": "listing-main-characteristics__number listing-main-characteristics__number--dimensions"}).text.strip()
-            living_area = re.sub(r"[^0-9.]", "", living_area)
-        except: living_area = None
+    try: stories = [int(main_specs[key]) for key in ["étage", "étages"] if key in main_specs][0]
+    except: stories = None
 
-        try:
-            land_area = listing[1].find("div", {"class": "listing-main-characteristics__item listing-main-characteristics__item--lot-dimensions"})
-            land_area = land_area.find("span", {"class": "listing-main-characteristics__number listing-main-characteristics__number--dimensions"}).text.strip()
-            land_area = re.sub(r"[^0-9.]", "", land_area)
-        except: land_area = None
+    try:
+        living_area = content.find("div", {"class": "listing-main-characteristics__item listing-main-characteristics__item--living-space-area"})
+        living_area = living_area.find("span", {"class": "listing-main-characteristics__number listing-main-characteristics__number--dimensions"}).text.strip()
+        living_area = re.sub(r"[^0-9.]", "", living_area)
+    except: living_area = None
 
-        other_specs = listing[1].find_all("div", {"class": "listing-box__dotted-row"})
-        other_specs = dict(re.sub("\\n\\s*\\n*", "|", x.text.strip()).split("|") for x in other_specs)
+    try:
+        land_area = content.find("div", {"class": "listing-main-characteristics__item listing-main-characteristics__item--lot-dimensions"})
+        land_area = land_area.find("span", {"class": "listing-main-characteristics__number listing-main-characteristics__number--dimensions"}).text.strip()
+        land_area = re.sub(r"[^0-9.]", "", land_area)
+    except: land_area = None
 
-        try: construction_year = int(other_specs["Année de construction"])
-        except: construction_year = None
+    other_specs = content.find_all("div", {"class": "listing-box__dotted-row"})
+    other_specs = dict(re.sub("\\n\\s*\\n*", "|", x.text.strip()).split("|") for x in other_specs)
 
-        try: property_style = other_specs["Style"]
-        except: property_style = None
+    try: construction_year = int(other_specs["Année de construction"])
+    except: construction_year = None
 
-        try: floors = other_specs["Situé à quel étage?"]
-        except: floors = None
+    try: property_style = other_specs["Style"]
+    except: property_style = None
 
-        try: municipal_valuation = sum([int(other_specs[key]) for key in ["Évaluation municipale", "Évaluation municipale du terrain", "Évaluation municipale du bâtiment"] if key in other_specs])
-        except: municipal_valuation = None
+    try: floors = other_specs["Situé à quel étage?"]
+    except: floors = None
 
-        try: parking_spaces = sum([int(other_specs[key]) for key in ["Nombre de stationnements", "Nombre de stationnements intérieur", "Nombre de stationnements extérieur"] if key in other_specs])
-        except: parking_spaces = None
+    try: municipal_valuation = sum([int(other_specs[key]) for key in ["Évaluation municipale", "Évaluation municipale du terrain", "Évaluation municipale du bâtiment"] if key in other_specs])
+    except: municipal_valuation = None
 
-        res.append([listing[0], bedrooms, bathrooms, powder_rooms, stories, living_area, land_area,
-                    construction_year, property_style, floors, municipal_valuation, parking_spaces])
+    try: parking_spaces = sum([int(other_specs[key]) for key in ["Nombre de stationnements", "Nombre de stationnements intérieur", "Nombre de stationnements extérieur"] if key in other_specs])
+    except: parking_spaces = None
 
+    return (listing[0], bedrooms, bathrooms, powder_rooms, stories, living_area, land_area,
+            construction_year, property_style, floors, municipal_valuation, parking_spaces)
+
+def duproprio_individual_info(raw_listing_html: list, listings: pd.DataFrame, pool: ProcessPoolExecutor = None) -> pd.DataFrame:
+    res = [row for row in parse_all(duproprio_listing_row, raw_listing_html, pool) if row is not None]
     res = pd.DataFrame(res, columns=['url', 'bedrooms', 'bathrooms', 'powder_rooms', 'stories', 'living_area', 'land_area',
                                      'construction_year', 'property_style', 'floors', 'municipal_valuation', 'parking_spaces'])
     return pd.merge(listings, res, on='url')
 
 ## RoyalLepage functions
 
-def royallepage_summary_raw() -> list:
-    raw_listings = []
-    nb = float("inf")
-    i = 1
+ROYALLEPAGE_CLASSES = has_classes("property-wrapper", "feed-3", "rlp")
+ROYALLEPAGE_LISTING = SoupStrainer("div", class_=ROYALLEPAGE_CLASSES)
 
-    session = requests.Session()
+def royallepage_page_url(i: int) -> str:
+    return f"https://www.royallepage.ca/fr/searchgeo/homes/qc/rosemontla-petite-patrie/{i}/%7Bi%7D/?search_str=Rosemont%E2%80%93La+Petite-Patrie%2C+Montr%C3%A9al%2C+QC%2C+CAN&csrfmiddlewaretoken=4McZvjFoVDaH7IUZtZBZkqipdIQpaTksLFTO3N9wXP9aq9p9XKVyz3dnN0cxZpem&property_type=&house_type=&features=&listing_type=&lat=45.561401723&lng=-73.590413287&upper_lat=&upper_lng=&lower_lat=&lower_lng=&bypass=&radius=5&zoom=&display_type=gallery-view&travel_time=&travel_time_min=30&travel_time_mode=drive&travel_time_congestion=&da_id=&segment_id=&tier2=False&tier2_proximity=0&address=Rosemont%E2%80%93La+Petite-Patrie&method=homes&address_type=city&city_name=Rosemont%E2%80%93La+Petite-Patrie&prov_code=QC&school_id=&boundary=&min_price=0&max_price=5000000%2B&min_leaseprice=0&max_leaseprice=5000%2B&beds=0&baths=0&transactionType=SALE&archive_timespan=3&keyword=&sortby="
 
-    while len(raw_listings) < nb:
-        url = f"https://www.royallepage.ca/fr/searchgeo/homes/qc/rosemontla-petite-patrie/{i}/%7Bi%7D/?search_str=Rosemont%E2%80%93La+Petite-Patrie%2C+Montr%C3%A9al%2C+QC%2C+CAN&csrfmiddlewaretoken=4McZvjFoVDaH7IUZtZBZkqipdIQpaTksLFTO3N9wXP9aq9p9XKVyz3dnN0cxZpem&property_type=&house_type=&features=&listing_type=&lat=45.561401723&lng=-73.590413287&upper_lat=&upper_lng=&lower_lat=&lower_lng=&bypass=&radius=5&zoom=&display_type=gallery-view&travel_time=&travel_time_min=30&travel_time_mode=drive&travel_time_congestion=&da_id=&segment_id=&tier2=False&tier2_proximity=0&address=Rosemont%E2%80%93La+Petite-Patrie&method=homes&address_type=city&city_name=Rosemont%E2%80%93La+Petite-Patrie&prov_code=QC&school_id=&boundary=&min_price=0&max_price=5000000%2B&min_leaseprice=0&max_leaseprice=5000%2B&beds=0&baths=0&transactionType=SALE&archive_timespan=3&keyword=&sortby="
-        soup = BeautifulSoup(session.get(url).text, "html5lib")
-        raw_listings.extend(soup.find_all("div", {"class": "card card--listing-card js-listing js-property-details"}))
-        nb = int(re.sub("\\s", "", unidecode(soup.find("span", {"id": "search-results-result-count"}).text.strip())))
-        i += 1
+def royallepage_summary_raw() -> list:
+    return paginate(
+        royallepage_page_url,
+        lambda soup: soup.find_all("div", {"class": "card card--listing-card js-listing js-property-details"}),
+        lambda soup: int(re.sub("\\s", "", unidecode(soup.find("span", {"id": "search-results-result-count"}).text.strip()))),
+        royallepage_summary_row
+    )
 
-    return raw_listings
+def royallepage_summary_row(listing) -> list:
+    try: url = listing.find("a").get("href")
+    except: url = None
 
-def royallepage_summary_info(raw_html: list) -> pd.DataFrame:
-    res = []
-    for listing in raw_html:
-        try: url = listing.find("a").get("href")
-        except: url = None
+    try: mls = re.search(r"mls(\\d+)", url).group(1)
+    except: mls = None
 
-        try: mls = re.search(r"mls(\\d+)", url).group(1)
-        except: mls = None
+    try: price = int(re.sub("\\s|\\$", "", listing.find("span", {"class": "title--h3 price"}).span.text))
+    except: price = None
 
-        try: price = int(re.sub("\\s|\\$", "", listing.find("span", {"class": "title--h3 price"}).span.text))
-        except: price = None
+    try: address = listing.find("img").get("alt")
+    except: address = None
 
-        try: address = listing.find("img").get("alt")
-        except: address = None
+    return [url, mls, price, address]
 
-        res.append([url, mls, price, address])
+def royallepage_summary_info(raw_html: list) -> pd.DataFrame:
+    # Les annonces des pages inchangées arrivent déjà sous forme de lignes
+    res = [listing if isinstance(listing, list) else royallepage_summary_row(listing) for listing in raw_html]
     return pd.DataFrame(res, columns=['url', 'mls', 'price', 'address'])
 
 def royallepage_individual_raw(urls: pd.Series) -> list:
-    raw_listings = []
-    session = requests.Session()
-    for url in urls:
-        soup = BeautifulSoup(session.get(url).text, "html5lib")
-        raw_listings.append([url, soup.find("div", {"class": "property-wrapper feed-3 rlp"})])
-    return raw_listings
-
-def royallepage_individual_info(raw_listing_html: list, listings: pd.DataFrame) -> pd.DataFrame:
-    res = []
-    for listing in raw_listing_html:
-        try:
-            main_specs = listing[1].find("div", {"class": "expandable-box__hidden js-expandable-box-target"})
-            main_specs = [re.sub("\\s?:?\\n\\s*", "|", unidecode(x.text).strip()).split("|") for x in main_specs.find_all("li")]
-            main_specs = dict(filter(lambda x: len(x) == 2, main_specs))
-        except: continue
+    urls = list(urls)
+    return [[url, page] for url, page in zip(urls, fetch_all(urls))]
 
-        try: bedrooms = int(main_specs['Chambres'])
-        except: bedrooms = None
+def royallepage_listing_row(listing: list):
+    """
+    Analyse la page HTML brute d'une annonce et retourne la ligne de caractéristiques, ou None.
+    Fonction de niveau module pour pouvoir être exécutée dans un processus de parsing.
+    """
+    content = parse_html(listing[1], ROYALLEPAGE_LISTING).find("div", class_=ROYALLEPAGE_CLASSES)
+    if content is None: return None
 
-        try: bathrooms = int(main_specs['Salle(s) de bains'])
-        except: bathrooms = None
+    try:
+        main_specs = content.find("div", {"class": "expandable-box__hidden js-expandable-box-target"})
+        main_specs = [re.sub("\\s?:?\\n\\s*", "|", unidecode(x.text).strip()).split("|") for x in main_specs.find_all("li")]
+        main_specs = dict(filter(lambda x: len(x) == 2, main_specs))
+    except: return None
 
-        try: powder_rooms = int(main_specs["Salle(s) d'eau"])
-        except: powder_rooms = None
+    try: bedrooms = int(main_specs['Chambres'])
+    except: bedrooms = None
 
-        try: stories = [int(main_specs[key]) for key in ["étage", "étages"] if key in main_specs][0]
-        except: stories = None
+    try: bathrooms = int(main_specs['Salle(s) de bains'])
+    except: bathrooms = None
 
-        try:
-            living_area = main_specs['Superficie habitable (approx)']
-            living_area = re.sub(r"[^0-9.]", "", living_area)
-        except: living_area = None
+    try: powder_rooms = int(main_specs["Salle(s) d'eau"])
+    except: powder_rooms = None
 
-        try:
-            land_area = listing[1].find("div", {"class": "listing-main-characteristics__item listing-main-characteristics__item--lot-dimensions"})
-            land_area = land_area.find("span", {"class": "listing-main-characteristics__number listing-main-characteristics__number--dimensions"}).text.strip()
-            land_area = re.sub(r"[^0-9.]", "", land_area)
-        except: land_area = None
+    try: stories = [int(main_specs[key]) for key in ["étage", "étages"] if key in main_specs][0]
+    except: stories = None
 
-        try: construction_year = int(main_specs['Bati en'])
-        except: construction_year = None
+    try:
+        living_area = main_specs['Superficie habitable (approx)']
+        living_area = re.sub(r"[^0-9.]", "", living_area)
+    except: living_area = None
 
-        try: property_style = other_specs["Style"]
-        except: property_style = None
+    try:
+        land_area = content.find("div", {"class": "listing-main-characteristics__item listing-main-characteristics__item--lot-dimensions"})
+        land_area = land_area.find("span", {"class": "listing-main-characteristics__number listing-main-characteristics__number--dimensions"}).text.strip()
+        land_area = re.sub(r"[^0-9.]", "", land_area)
+    except: land_area = None
 
-        try: floors = other_specs["Situé à quel étage?"]
-        except: floors = None
+    try: construction_year = int(main_specs['Bati en'])
+    except: construction_year = None
 
-        #TODO déterminer si c'est la bonne valeur
-        try: municipal_valuation = int(re.sub("\\s|\\$", "", main_specs['Evaluation totale']))
-        except: municipal_valuation = None
+    try: property_style = other_specs["Style"]
+    except: property_style = None
 
-        try: parking_spaces = int(main_specs["Nbre d'espaces de stationnement"])
-        except: parking_spaces = None
+    try: floors = other_specs["Situé à quel étage?"]
+    except: floors = None
 
-        try: municipal_tax = int(re.sub("\\s|\\$", "", main_specs['Taxes municipales']))
-        except: municipal_tax = None
+    #TODO déterminer si c'est la bonne valeur
+    try: municipal_valuation = int(re.sub("\\s|\\$", "", main_specs['Evaluation totale']))
+    except: municipal_valuation = None
 
-        try: school_tax = int(re.sub("\\s|\\$", "", main_specs['Taxe scolaire']))
-        except: school_tax = None
+    try: parking_spaces = int(main_specs["Nbre d'espaces de stationnement"])
+    except: parking_spaces = None
 
-        res.append([listing[0], bedrooms, bathrooms, powder_rooms, stories, living_area, land_area,
-                    construction_year, property_style, floors, municipal_valuation, parking_spaces])
+    try: municipal_tax = int(re.sub("\\s|\\$", "", main_specs['Taxes municipales']))
+    except: municipal_tax = None
 
+    try: school_tax = int(re.sub("\\s|\\$", "", main_specs['Taxe scolaire']))
+    except: school_tax = None
+
+    return (listing[0], bedrooms, bathrooms, powder_rooms, stories, living_area, land_area,
+            construction_year, property_style, floors, municipal_valuation, parking_spaces)
+
+def royallepage_individual_info(raw_listing_html: list, listings: pd.DataFrame, pool: ProcessPoolExecutor = None) -> pd.DataFrame:
+    res = [row for row in parse_all(royallepage_listing_row, raw_listing_html, pool) if row is not None]
     res = pd.DataFrame(res, columns=['url', 'bedrooms', 'bathrooms', 'powder_rooms', 'stories', 'living_area', 'land_area',
                                      'construction_year', 'property_style', 'floors', 'municipal_valuation', 'parking_spaces'])
     return pd.merge(listings, res, on='url').drop_duplicates()
@@ -291,117 +769,272 @@ def db_current_info(conn):
     cursor.close()
     return pd.DataFrame(rows, columns=colnames)
 
+LOGEMENT_COLUMNS = ['url', 'price', 'address', 'bedrooms', 'bathrooms', 'powder_rooms', 'stories', 'living_area', 'land_area',
+                    'construction_year', 'property_style', 'floors', 'municipal_valuation', 'parking_spaces', 'latitude', 'longitude', 'postal_code', 'fsa']
+INTEGER_COLUMNS = {'bedrooms', 'bathrooms', 'powder_rooms', 'stories', 'construction_year', 'floors', 'parking_spaces'}
+
+def copy_value(column, value):
+    # Les colonnes entières deviennent des floats dans pandas dès qu'une valeur manque
+    if isinstance(value, float) and column in INTEGER_COLUMNS and value.is_integer():
+        return int(value)
+    return value
+
+def copy_staging(cursor, table: str, df: pd.DataFrame):
+    """
+    Crée une table temporaire avec les types des colonnes de la table cible et y charge le
+    DataFrame en un seul COPY. La colonne ord conserve l'ordre des lignes du DataFrame.
+    """
+    columns = ', '.join(LOGEMENT_COLUMNS)
+    cursor.execute(f'CREATE TEMP TABLE staging ON COMMIT DROP AS SELECT {columns} FROM "{table}" WITH NO DATA')
+    cursor.execute('ALTER TABLE staging ADD COLUMN ord INT')
+
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for i, row in enumerate(df.to_dict('records')):
+        writer.writerow([copy_value(column, row.get(column)) for column in LOGEMENT_COLUMNS] + [i])
+    buffer.seek(0)
+    cursor.copy_expert(f"COPY staging ({columns}, ord) FROM STDIN WITH (FORMAT csv)", buffer)
+
+# Une url présente plusieurs fois dans le staging garde sa dernière occurrence, dans Logements comme dans le DW
+STAGING_LATEST = "(SELECT DISTINCT ON (url) * FROM staging ORDER BY url, ord DESC)"
+
+def dw_insert_from_staging(cursor, state='new'):
+    """
+    Historise dw_dim_logements (SCD type 2) dans la transaction en cours: la version courante de
+    chaque url du staging est fermée (valid_to, is_current), puis la nouvelle version courante est insérée.
+    Pour un changement de prix ou une vente, les caractéristiques sont reprises de la version fermée;
+    une vente garde le dernier prix connu. Chaque nouvelle version est aussi ajoutée à
+    fact_price_events, et les médianes du jour et de la semaine des FSA touchées sont recalculées.
+    """
+    columns = ', '.join(LOGEMENT_COLUMNS)
+    if state == 'new':
+        values = ', '.join(f"s.{c}" for c in LOGEMENT_COLUMNS)
+    else:
+        price = "s.price" if state == 'price_change' else "COALESCE(c.price, s.price)"
+        values = ', '.join("s.url" if c == 'url' else price if c == 'price' else f"COALESCE(c.{c}, s.{c})"
+                           for c in LOGEMENT_COLUMNS)
+
+    close = """
+        UPDATE "dw_dim_logements" d SET valid_to = CURRENT_TIMESTAMP, is_current = FALSE
+        FROM staging s WHERE d.url = s.url AND d.is_current"""
+    if state == 'new':
+        # Aucune valeur à reprendre: la version courante d'une annonce republiée est simplement fermée
+        cursor.execute(close)
+        closed, source = "", f"{STAGING_LATEST} s"
+    else:
+        # Les versions fermées sont jointes directement depuis le RETURNING de l'UPDATE, qui
+        # s'exécute avant l'insertion de la nouvelle version courante de chaque url
+        closed, source = f"closed AS ({close} RETURNING d.*), ", f"{STAGING_LATEST} s LEFT JOIN closed c ON c.url = s.url"
+
+    cursor.execute("SELECT create_price_events_partition(LOCALTIMESTAMP)")
+    cursor.execute(f"""
+        WITH {closed}v AS (
+            INSERT INTO "dw_dim_logements" ({columns}, state, update_date, valid_from, is_current)
+            SELECT {values}, %s, LOCALTIMESTAMP, CURRENT_TIMESTAMP, TRUE
+            FROM {source}
+            ORDER BY s.ord
+            RETURNING dw_id, url, fsa, price, state, update_date
+        ), e AS (
+            INSERT INTO fact_price_events (logement_id, url, fsa, price, event_type, update_date)
+            SELECT dw_id, url, fsa, price, state, update_date FROM v
+            RETURNING fsa
+        )
+        SELECT DISTINCT fsa::TEXT FROM e WHERE fsa IS NOT NULL""", (state,))
+    # FSA des événements insérés ci-dessus, sans relire fact_price_events
+    fsas = [row[0] for row in cursor.fetchall()]
+    if fsas:
+        cursor.execute("SELECT refresh_price_rollups(LOCALTIMESTAMP, LOCALTIMESTAMP, %s)", (fsas,))
+
 def db_dw_add_new_info(conns, df):
     df.replace('', None, inplace=True)
     df.replace(np.nan, None, inplace=True)
-    
+    if df.empty:
+        return
+
+    columns = ', '.join(LOGEMENT_COLUMNS)
     with conns[0].cursor() as cursor:
-        for index, row in df.iterrows():
-            cursor.execute(
-                """
-                INSERT INTO "Logements" (url, price, address, bedrooms, bathrooms, powder_rooms, stories, living_area, land_area,
-                                         construction_year, property_style, floors, municipal_valuation, parking_spaces, latitude, longitude, postal_code, fsa)
-                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-                ON CONFLICT (url) DO NOTHING
-                """,
-                (row.get('url'), row.get('price'), row.get('address'), row.get('bedrooms'), row.get('bathrooms'), row.get('powder_rooms'), row.get('stories'), row.get('living_area'), row.get('land_area'),
-                 row.get('construction_year'), row.get('property_style'), row.get('floors'), row.get('municipal_valuation'), row.get('parking_spaces'), row.get('latitude'), row.get('longitude'), row.get('postal_code'), row.get('fsa'))
-            )
+        copy_staging(cursor, "Logements", df)
+        cursor.execute(f"""
+            INSERT INTO "Logements" ({columns})
+            SELECT {columns} FROM {STAGING_LATEST} s ORDER BY ord
+            ON CONFLICT (url) DO NOTHING""")
     conns[0].commit()
-    
+
     with conns[1].cursor() as cursor:
-        for index, row in df.iterrows():
-            cursor.execute(
-                """
-                INSERT INTO "dw_dim_logements" (url, price, address, bedrooms, bathrooms, powder_rooms, stories, living_area, land_area,
-                                                construction_year, property_style, floors, municipal_valuation, parking_spaces, latitude, longitude, postal_code, fsa)
-                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-                """,
-                (row.get('url'), row.get('price'), row.get('address'), row.get('bedrooms'), row.get('bathrooms'), row.get('powder_rooms'), row.get('stories'), row.get('living_area'), row.get('land_area'),
-                 row.get('construction_year'), row.get('property_style'), row.get('floors'), row.get('municipal_valuation'), row.get('parking_spaces'), row.get('latitude'), row.get('longitude'), row.get('postal_code'), row.get('fsa'))
-            )
+        copy_staging(cursor, "dw_dim_logements", df)
+        dw_insert_from_staging(cursor)
     conns[1].commit()
-    
+
 def db_update_price(conns, df):
+    if df.empty:
+        return
+
     with conns[0].cursor() as cursor:
-        for index, row in df.iterrows():
-            cursor.execute("""UPDATE "Logements" SET price = %s WHERE url = %s""", (row.get('price'), row.get('url')))
+        copy_staging(cursor, "Logements", df)
+        cursor.execute(f"""
+            UPDATE "Logements" l SET price = s.price
+            FROM {STAGING_LATEST} s
+            WHERE l.url = s.url""")
     conns[0].commit()
-    
+
     with conns[1].cursor() as cursor:
-        for index, row in df.iterrows():
-            cursor.execute(
-                """
-                INSERT INTO "dw_dim_logements" (url, price, address, bedrooms, bathrooms, powder_rooms, stories, living_area, land_area,
-                                                construction_year, property_style, floors, municipal_valuation, parking_spaces, latitude, longitude, postal_code, fsa,
-                                                state)
-                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-                """,
-                (row.get('url'), row.get('price'), row.get('address'), row.get('bedrooms'), row.get('bathrooms'), row.get('powder_rooms'), row.get('stories'), row.get('living_area'), row.get('land_area'),
-                 row.get('construction_year'), row.get('property_style'), row.get('floors'), row.get('municipal_valuation'), row.get('parking_spaces'), row.get('latitude'), row.get('longitude'), row.get('postal_code'), row.get('fsa'),
-                 'price_change')
-            )
+        copy_staging(cursor, "dw_dim_logements", df)
+        dw_insert_from_staging(cursor, 'price_change')
     conns[1].commit()
-    
+
 def db_remove_sold_info(conns, df):
+    if df.empty:
+        return
+
     with conns[0].cursor() as cursor:
-        for index, row in df.iterrows():
-            cursor.execute("""DELETE FROM "Logements" WHERE url = %s""", (row.get('url'),))
+        copy_staging(cursor, "Logements", df)
+        cursor.execute("""DELETE FROM "Logements" l USING staging s WHERE l.url = s.url""")
     conns[0].commit()
-    
+
     with conns[1].cursor() as cursor:
-        for index, row in df.iterrows():
-            cursor.execute(
-                """
-                INSERT INTO "dw_dim_logements" (url, price, address, bedrooms, bathrooms, powder_rooms, stories, living_area, land_area,
-                                                construction_year, property_style, floors, municipal_valuation, parking_spaces, latitude, longitude, postal_code, fsa,
-                                                state)
-                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-                """,
-                (row.get('url'), row.get('price'), row.get('address'), row.get('bedrooms'), row.get('bathrooms'), row.get('powder_rooms'), row.get('stories'), row.get('living_area'), row.get('land_area'),
-                 row.get('construction_year'), row.get('property_style'), row.get('floors'), row.get('municipal_valuation'), row.get('parking_spaces'), row.get('latitude'), row.get('longitude'), row.get('postal_code'), row.get('fsa'),
-                 'sold')
-            )
+        copy_staging(cursor, "dw_dim_logements", df)
+        dw_insert_from_staging(cursor, 'sold')
     conns[1].commit()
-    
+
+def db_summary_changes(conn, listings: list) -> tuple:
+    """
+    Même résultat que define_summary_changes, mais calculé dans PostgreSQL: les couples (url, prix)
+    collectés sont chargés par COPY dans une table temporaire, une jointure externe complète avec
+    "Logements" classe chaque annonce, et seules les annonces modifiées sont lues, par lots, via un
+    curseur côté serveur. L'inventaire complet n'est jamais chargé en mémoire.
+    """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for listing in listings:
+        prices = listing['price'].astype(object).where(listing['price'].notna(), None)
+        writer.writerows(zip(listing['url'], prices))
+    buffer.seek(0)
+
+    with conn.cursor() as cursor:
+        cursor.execute("CREATE TEMP TABLE scraped (url TEXT, price DOUBLE PRECISION) ON COMMIT DROP")
+        cursor.copy_expert("COPY scraped (url, price) FROM STDIN WITH (FORMAT csv)", buffer)
+
+    rows = []
+    with conn.cursor(name='summary_changes') as cursor:
+        cursor.itersize = 10000
+        cursor.execute("""
+            SELECT COALESCE(s.url, l.url) AS url, s.price,
+                   CASE WHEN s.price IS NULL THEN 'sold' WHEN l.price IS NULL THEN 'new' ELSE 'price_change' END AS action
+            FROM scraped s FULL OUTER JOIN "Logements" l ON l.url = s.url
+            WHERE s.price IS NULL OR l.price IS NULL OR s.price <> l.price""")
+        for row in cursor:
+            rows.append(row)
+    conn.commit()
+
+    df = pd.DataFrame(rows, columns=['url', 'price', 'action'])
+    return df[df['url'].str.contains('duproprio')], df[~df['url'].str.contains('duproprio')]
+
+## Replay
+
+def replay(run=None):
+    """
+    Rejoue l'analyse complète sur les pages archivées, dans leur version du run donné (ou la plus
+    récente), sans accès réseau, sans géocodage et sans écriture en base. Les résultats sont
+    enregistrés en CSV dans REPLAY_OUTPUT.
+    """
+    global REPLAY_RUN
+    REPLAY_RUN = run or RUN_ID
+    os.makedirs(REPLAY_OUTPUT, exist_ok=True)
+
+    sources = {
+        'duproprio': (duproprio_summary_raw, duproprio_summary_info, duproprio_individual_raw, duproprio_individual_info),
+        'royallepage': (royallepage_summary_raw, royallepage_summary_info, royallepage_individual_raw, royallepage_individual_info)
+    }
+    for name, (summary_raw, summary_info, individual_raw, individual_info) in sources.items():
+        start = time.perf_counter()
+        summary = summary_info(summary_raw())
+        individual = individual_info(individual_raw(summary['url'].dropna()), summary)
+        individual.to_csv(os.path.join(REPLAY_OUTPUT, f"{name}_{REPLAY_RUN}.csv"), index=False)
+        print(f"{name}: {len(summary)} annonces, {len(individual)} fiches analysées en {time.perf_counter() - start:.1f} s")
+
+## Update pipeline
+
+def batches(items, size: int):
+    items = list(items)
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+def prefetch(iterable, depth: int = 1):
+    """
+    Calcule les éléments d'un itérable à l'avance dans un thread, avec au plus `depth` éléments
+    en attente: l'étape en amont est bloquée tant que l'étape en aval n'a pas consommé (backpressure).
+    """
+    queue = Queue(maxsize=depth)
+    done = object()
+
+    def produce():
+        try:
+            for item in iterable:
+                queue.put((item, None))
+        except Exception as e:
+            queue.put((None, e))
+        finally:
+            queue.put((done, None))
+
+    threading.Thread(target=produce, daemon=True).start()
+    while True:
+        item, error = queue.get()
+        if error is not None:
+            raise error
+        if item is done:
+            return
+        yield item
+
+def stream_new_listings(urls, listings: pd.DataFrame, individual_raw, individual_info, pool: ProcessPoolExecutor):
+    """
+    Pipeline fetch -> parse -> géocodage par micro-lots de UPDATE_BATCH_SIZE annonces: le
+    téléchargement du lot suivant se fait pendant l'analyse et le géocodage du lot courant.
+    Tous les lots sont analysés dans le même pool de processus.
+    """
+    fetched = prefetch((individual_raw(batch) for batch in batches(urls, UPDATE_BATCH_SIZE)), UPDATE_PREFETCH)
+    for raw_listings in fetched:
+        yield enhance(individual_info(raw_listings, listings, pool))
+
+def update_source(conns, name: str, listings: pd.DataFrame, changes: pd.DataFrame, individual_raw, individual_info, pool: ProcessPoolExecutor):
+    added = 0
+    for batch in stream_new_listings(changes[changes['action'] == 'new']['url'], listings, individual_raw, individual_info, pool):
+        db_dw_add_new_info(conns, batch)
+        added += len(batch)
+        print(f"{name}: {added} nouvelles annonces enregistrées")
+
+    db_update_price(conns, changes[changes['action'] == 'price_change'])
+
+    db_remove_sold_info(conns, changes[changes['action'] == 'sold'])
+
+    # Indicateurs d'accessibilité des nouvelles annonces (ceux des annonces vendues sont supprimés)
+    computed = refresh_features(conns[0])
+    print(f"{name}: indicateurs d'accessibilité calculés pour {computed} annonces")
+
+    print(f"{name} listings updated")
+
 ## Database update
 if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "--replay":
+        replay(sys.argv[2] if len(sys.argv) > 2 else None)
+        sys.exit(0)
+
     conns = connect_to_postgres()
-    current_info = db_current_info(conns[0])
-    
-    duproprio_summary_raw = duproprio_summary_raw()
-    duproprio_summary_info = duproprio_summary_info(duproprio_summary_raw)
+    # Un seul pool de parsing pour tous les lots des deux sources
+    pool = parse_pool()
 
-    royallepage_summary_raw = royallepage_summary_raw()
-    royallepage_summary_info = royallepage_summary_info(royallepage_summary_raw)
+    duproprio_summary = duproprio_summary_info(duproprio_summary_raw())
+    royallepage_summary = royallepage_summary_info(royallepage_summary_raw())
 
-    duproprio_summary_changes, royallepage_summary_changes = define_summary_changes([duproprio_summary_info, royallepage_summary_info], current_info)
-    
-    # DuProprio
-    
-    duproprio_individual_raw = duproprio_individual_raw(duproprio_summary_changes[duproprio_summary_changes['action'] == 'new']['url'])
-    duproprio_individual_info = duproprio_individual_info(duproprio_individual_raw, duproprio_summary_info)
-    duproprio_enhance_info = enhance(duproprio_individual_info)
-    db_dw_add_new_info(conns, duproprio_enhance_info)
-    
-    db_update_price(conns, duproprio_summary_changes[duproprio_summary_changes['action'] == 'price_change'])
-    
-    db_remove_sold_info(conns, duproprio_summary_changes[duproprio_summary_changes['action'] == 'sold'])
-    
-    print("DuProprio listings updated")
+    if CHANGE_DETECTION == 'sql':
+        duproprio_summary_changes, royallepage_summary_changes = db_summary_changes(conns[0], [duproprio_summary, royallepage_summary])
+    else:
+        current_info = db_current_info(conns[0])
+        duproprio_summary_changes, royallepage_summary_changes = define_summary_changes([duproprio_summary, royallepage_summary], current_info)
 
-    # RoyalLepage
-    
-    royallepage_individual_raw = royallepage_individual_raw(royallepage_summary_changes[royallepage_summary_changes['action'] == 'new']['url'])
-    royallepage_individual_info = royallepage_individual_info(royallepage_individual_raw, royallepage_summary_info)
-    royallepage_enhance_info = enhance(royallepage_individual_info)
-    db_dw_add_new_info(conns, royallepage_enhance_info)
-    
-    db_update_price(conns, royallepage_summary_changes[royallepage_summary_changes['action'] == 'price_change'])
+    update_source(conns, "DuProprio", duproprio_summary, duproprio_summary_changes, duproprio_individual_raw, duproprio_individual_info, pool)
 
-    db_remove_sold_info(conns, royallepage_summary_changes[royallepage_summary_changes['action'] == 'sold'])
-    
-    print("RoyalLepage listings updated")
-    
+    update_source(conns, "RoyalLepage", royallepage_summary, royallepage_summary_changes, royallepage_individual_raw, royallepage_individual_info, pool)
+
+    pool.shutdown()
     conns[0].close()
     conns[1].close()